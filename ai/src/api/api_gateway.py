@@ -1,17 +1,25 @@
+import io
+import json
 import os
+import queue
 import sys
 import zipfile
-from flask import Flask, request, jsonify, send_file
-from pymongo import MongoClient
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from flask import Flask, Response, request, jsonify, send_file
 
 # Add the parent directory to the path
 sys.path.append(os.path.join(os.getcwd(), ".."))
 
 # Import the functions now that the path is set
-from ai.src.generator.generator_handler import generate_sheets
-from ai.src.evaluator.preprocessor import map_pages_to_students, preprocess_image, create_temp_pdfs
-from ai.src.evaluator.evaluator import transform_eval_output
+from ai.src.generator.generator_handler import generate_sheets, regenerate_sheets
+from ai.src.evaluator.preprocessor import map_pages_to_students, merge_page_answers, warmup_page_workers, \
+    page_workers_ready
+from ai.src.evaluator.evaluator import transform_eval_output, load_test
+from ai.src.evaluator.qr_reader import warmup, is_ready, get_qr_stats
+from ai.src.api.jobs import JobQueue
+from ai.src.db.quiz_store import ensure_indexes
+from ai.src.db.connection import create_client, LatencyStats
+from ai.src.utils import load_config
 
 
 # Initialize the Flask app
@@ -33,12 +41,22 @@ else:
 # MongoDB URI
 uri = f"mongodb://{mongo_service_host}:{mongo_service_port}"
 
-# Connect to MongoDB
-client = MongoClient(uri)
+# Connect to MongoDB (pool size, timeouts and read preference are in the "database" section of the config,
+# see CLIENT_SETTINGS, the connection is made in the background with the first query)
+db_stats = LatencyStats()
+client = create_client(uri, load_config(), db_stats)
 # Get the database and collection
 db = client['adt']
 collection = db['quizes']
 
+# Background jobs (evaluation of large scans without holding the HTTP connection open)
+jobs_config = load_config()["jobs"]
+job_queue = JobQueue(jobs_config["workers"], jobs_config["keep_seconds"])
+
+QR_ERROR = "Error reading the QR codes. Please try again."
+# Seconds without any record after which the stream sends a keepalive record (e.g. while looking for the QR code)
+STREAM_KEEPALIVE_SECONDS = 10
+
 
 def catch_errors(func):
     """
@@ -61,13 +79,49 @@ def catch_errors(func):
     return wrapper
 
 
+def send_zip(pdfs):
+    """
+    Zip the PDFs in memory and send them as an attachment
+    :param pdfs: Dictionary of file names and PDFs (bytes)
+    :return: ZIP file response
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for file_name, pdf in pdfs.items():
+            zipf.writestr(file_name, pdf)
+    buffer.seek(0)
+
+    return send_file(buffer, mimetype='application/zip', as_attachment=True, download_name="pdfs.zip")
+
+
+def format_date(iso_date):
+    """
+    Convert the date from the request to the format printed on the sheets
+    :param iso_date: ISO string date
+    :return: Date as DD. MM. YYYY
+    """
+    date = iso_date.split("T")[0].split("-")
+    return f"{date[2]}. {date[1]}. {date[0]}"
+
+
 @app.route('/healthcheck', methods=['GET'])
 def healthcheck():
     """
     Simple ping endpoint to check if the service is running
+    Ready is false until the QR code readers are loaded (evaluation would wait for them), also the ones of the worker
+    processes if the pages are analysed in processes
     :return: JSON response
     """
-    return jsonify({'status': 'OK'})
+    return jsonify({'status': 'OK', 'ready': is_ready() and page_workers_ready()})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Statistics of the service
+    :return: JSON response
+    """
+    return jsonify({'qr_decoders': get_qr_stats(), 'database': db_stats.to_dict()})
 
 
 @app.route('/get_print_data', methods=['POST'])
@@ -82,25 +136,39 @@ def get_data():
 
         questions = data["questions"]
         students = data["students"]
-        date = data["date"]
-
-        # ISO string date to DD.MM.YYYY
-        date = date.split("T")[0].split("-")
-        date = f"{date[2]}. {date[1]}. {date[0]}"
+        date = format_date(data["date"])
 
         # Generate the bubble sheets and question papers
-        generate_sheets(collection, questions, students, date)
-
-        # PDF files to be zipped
-        pdf_files = ["generated_pdfs/bubble_sheets.pdf", "generated_pdfs/question_papers.pdf"]
-        zip_file = os.path.join(os.getcwd(), "generated_pdfs/pdfs.zip")
+        bubble_sheets, question_papers = generate_sheets(collection, questions, students, date)
 
         # Create a zip file containing the PDF files
-        with zipfile.ZipFile(zip_file, 'w') as zipf:
-            for pdf_file in pdf_files:
-                zipf.write(pdf_file, arcname=os.path.basename(pdf_file))
+        return send_zip({"bubble_sheets.pdf": bubble_sheets, "question_papers.pdf": question_papers})
+
+    return catch_errors(inner_func)()
+
+
+@app.route('/update_print_data', methods=['POST'])
+def update_print_data():
+    """
+    Add students to an existing test or generate the printouts of some of its students again (e.g. a corrected name)
+    Only the given students are rendered, the saved questions and shuffles are reused
+    :return: ZIP file containing the PDFs of the given students and their IDs
+    """
+    def inner_func():
+        # Get the data from the request
+        data = request.get_json()
+
+        test_id = data["test_id"]
+        students = data["students"]
+        # The date saved with the test is used if it is not given
+        date = format_date(data["date"]) if data.get("date") else None
 
-        return send_file(zip_file, as_attachment=True)
+        # Generate the bubble sheets and question papers of the given students only
+        bubble_sheets, question_papers, students = regenerate_sheets(collection, test_id, students, date)
+
+        # Create a zip file containing the PDF files
+        return send_zip({"bubble_sheets.pdf": bubble_sheets, "question_papers.pdf": question_papers,
+                         "students.json": json.dumps(students, ensure_ascii=False).encode("utf-8")})
 
     return catch_errors(inner_func)()
 
@@ -117,11 +185,7 @@ def generate_gc_data():
 
         questions = data["questions"]
         students = data["students"]
-        date = data["date"]
-
-        # ISO string date to DD.MM.YYYY
-        date = date.split("T")[0].split("-")
-        date = f"{date[2]}. {date[1]}. {date[0]}"
+        date = format_date(data["date"])
 
         # Preprocess the questions so they match the expected format from Moodle -- we can call our Moodle functions
         for question in questions:
@@ -150,110 +214,260 @@ def generate_gc_data():
                 answer["fraction"] *= 100  # Moodle gives the fractions as percentages
 
         # Generate the bubble sheets and question papers as if Moodle export
-        generate_sheets(collection, questions, students, date, gc=True)
-
-        # PDF files to be zipped
-        pdf_files = ["generated_pdfs/bubble_sheets.pdf", "generated_pdfs/question_papers.pdf"]
-        zip_file = os.path.join(os.getcwd(), "generated_pdfs/pdfs.zip")
+        bubble_sheets, question_papers = generate_sheets(collection, questions, students, date, gc=True)
 
         # Create a zip file containing the PDF files
-        with zipfile.ZipFile(zip_file, 'w') as zipf:
-            for pdf_file in pdf_files:
-                zipf.write(pdf_file, arcname=os.path.basename(pdf_file))
-
-        return send_file(zip_file, as_attachment=True)
+        return send_zip({"bubble_sheets.pdf": bubble_sheets, "question_papers.pdf": question_papers})
 
     return catch_errors(inner_func)()
 
 
+def process_student(i, pages, db_data, answer_key):
+    """
+    Process pages of one student at a time
+    Function to be used for parallel processing
+    :param i: Index of the first page of the student in the PDF
+    :param pages: Analyses of every page of the student
+    :param db_data: Test data from the database (see load_test)
+    :param answer_key: Answer key of the test
+    :return: JSON response containing the student ID and answers
+    """
+    try:
+        # Merge the pages and get the evaluation output
+        json_data = merge_page_answers(pages)
+
+        # Transform the output to a Moodle happy output
+        student_result, student_log = transform_eval_output(json_data, db_data, answer_key)
+
+        # Skip if the student was not found in the database (most likely due to bad ID detection)
+        if student_result is None:
+            err_msg = f"ERROR: Evaluation failed on page {i + 1}! Student with {json_data['student_id']} ID not found in the database! (ID detection failed)"
+            err_dict = {"error": err_msg, "result": []}
+            return {"result": err_dict, "log": err_msg, "review": []}
+
+        # Bubbles to be checked by a human are listed separately (with the student they belong to)
+        student_review = [dict(item, os_cislo=student_result["os_cislo"], login=student_result["login"])
+                          for item in student_result.pop("review")]
+
+        # Return the student result and log
+        return {"result": student_result, "log": student_log, "review": student_review}
+    except Exception as e:
+        # On error, return an error message
+        err_msg = f"ERROR: Evaluation failed on page {i + 1}! {e}"
+        err_dict = {"error": err_msg, "result": []}
+        return {"result": err_dict, "log": err_msg, "review": []}
+
+
+def score_student(test_id, pages, tests):
+    """
+    Evaluate one student as soon as all the pages of the student are read
+    :param test_id: Test ID
+    :param pages: Analyses of every page of the student
+    :param tests: Already loaded tests {test ID: (test data, answer key)}, the test is loaded on the first use
+    :return: Index of the first page of the student in the PDF and the output of process_student
+    """
+    if test_id not in tests:
+        db_data, answer_key = load_test(collection, test_id)
+        if db_data is None:
+            raise ValueError(f"Test {test_id} not found in the database!")
+        tests[test_id] = db_data, answer_key
+
+    first_page = min(page.pdf_page_index for page in pages)
+    return first_page, process_student(first_page, pages, *tests[test_id])
+
+
+def evaluate_pdf(file_data, thumbnails=False, job=None):
+    """
+    Evaluate the answers from the PDF
+    :param file_data: PDF file (bytes) with the scanned pages
+    :param thumbnails: If true, the images of the bubbles to be checked by a human are added to the review list
+    :param job: Job (see JobQueue) to report the progress to, or None
+    :return: Dictionary containing the results of the students, log and the list of the bubbles to be checked
+             by a human (or the error)
+    """
+    progress = job.update_pages if job is not None else None
+    # Outputs of the students by the first page of the student in the PDF
+    outputs = {}
+    tests = {}
+
+    def on_student(test_id, pages):
+        """
+        Evaluate the student as soon as all of its pages are read (the other pages are still being analysed)
+        :param test_id: Test ID
+        :param pages: Analyses of every page of the student
+        """
+        first_page, output = score_student(test_id, pages, tests)
+        outputs[first_page] = output
+        if job is not None:
+            job.add_partial_result(output["result"])
+
+    # Extract text from the PDF (pages are rasterized, deskewed and read here, one page at a time)
+    student_page_ids, _, _ = map_pages_to_students(collection, file_data, thumbnails=thumbnails, progress=progress,
+                                                   on_student=on_student)
+    # If the none of the QR codes worked (could not read the test ID), return an error
+    if student_page_ids is None:
+        return {"error": QR_ERROR}
+
+    # The results are kept in the order of the students in the PDF
+    outputs = [outputs[first_page] for first_page in sorted(outputs)]
+
+    result = [output["result"] for output in outputs]
+    log = "\n".join(output["log"] for output in outputs)
+    review = [item for output in outputs for item in output["review"]]
+
+    return {"result": result, "log": log, "review": review}
+
+
+def stream_evaluation(file_data, thumbnails=False):
+    """
+    Evaluate the answers from the PDF and yield every student as soon as all of its pages are read (NDJSON)
+    Records: {"type": "progress", "pages_done", "pages_failed", "pages_total"} after every analysed page,
+    {"type": "student", "page", "result", "log", "review"} in the order of completion (page is the index of the first
+    page of the student in the PDF), {"type": "keepalive"} if there was no record for STREAM_KEEPALIVE_SECONDS,
+    then {"type": "summary", ...}, or the {"type": "error", "error"} record as the last one
+    :param file_data: PDF file (bytes) with the scanned pages
+    :param thumbnails: If true, the images of the bubbles to be checked by a human are added to the review list
+    :return: Generator of JSON lines
+    """
+    def record(data):
+        return json.dumps(data) + "\n"
+
+    # The pages are analysed in the background, the records are sent as soon as they are put here (None = finished)
+    records = queue.Queue()
+    tests = {}
+
+    def on_progress(pages_done, pages_failed, pages_total):
+        """
+        Send the progress of the pages
+        :param pages_done: Number of analysed pages
+        :param pages_failed: Number of pages that could not be read
+        :param pages_total: Number of all pages
+        """
+        records.put({"type": "progress", "pages_done": pages_done, "pages_failed": pages_failed,
+                     "pages_total": pages_total})
+
+    def on_student(test_id, pages):
+        """
+        Evaluate and send the student as soon as all of its pages are read (the other pages are still being analysed)
+        :param test_id: Test ID
+        :param pages: Analyses of every page of the student
+        """
+        first_page, output = score_student(test_id, pages, tests)
+        records.put(dict(output, type="student", page=first_page))
+
+    def analyse():
+        """
+        Analyse the pages (background thread)
+        """
+        try:
+            student_page_ids, _, _ = map_pages_to_students(collection, file_data, thumbnails=thumbnails,
+                                                           progress=on_progress, on_student=on_student)
+            # If the none of the QR codes worked (could not read the test ID), return an error
+            records.put({"type": "error", "error": QR_ERROR} if student_page_ids is None else None)
+        except Exception as e:
+            # The response has already started, the error is the last record
+            print(f'An error occurred: {e}')
+            records.put({"type": "error", "error": f'An error occurred: {e}'})
+
+    threading.Thread(target=analyse, daemon=True).start()
+
+    num_of_students = 0
+    num_of_failed = 0
+    num_of_review = 0
+    while True:
+        try:
+            data = records.get(timeout=STREAM_KEEPALIVE_SECONDS)
+        except queue.Empty:
+            yield record({"type": "keepalive"})
+            continue
+        if data is None:
+            break
+        yield record(data)
+        if data["type"] == "error":
+            return
+        if data["type"] == "student":
+            num_of_students += 1
+            num_of_failed += "error" in data["result"]
+            num_of_review += len(data["review"])
+
+    yield record({"type": "summary", "students": num_of_students, "failed": num_of_failed, "review": num_of_review})
+
+
 @app.route('/test_evaluation', methods=['POST'])
 def evaluate_answers():
     """
     Evaluate the answers from the PDF
-    :return: JSON response containing the student ID and answers
+    Query parameter thumbnails=1 adds the images of the bubbles to be checked by a human to the review list
+    Query parameter stream=1 returns the progress and every student as soon as it is evaluated (NDJSON, see stream_evaluation)
+    :return: JSON response containing the student ID and answers and the list of the bubbles to be checked by a human
     """
     if not request.data:
         return jsonify({'error': 'No file part'})
 
     def inner_func():
-        # Get the data from the request
-        file_data = request.data
-
-        # Save the PDF file temporarily
-        with open('temp.pdf', 'wb') as fp:
-            fp.write(file_data)
-
-        # Extract text from the PDF
-        student_page_ids, test_id = map_pages_to_students(collection, "temp.pdf")
-        # If the none of the QR codes worked (could not read the test ID), return an error
-        if student_page_ids is None:
-            return jsonify({"error": "Error reading the QR codes. Please try again."})
-        # Create temporary PDFs for each student
-        pdf_names = create_temp_pdfs(student_page_ids, "temp.pdf")
-        os.remove("temp.pdf")
-
-        result = []
-        logs = []
-
-        def process_pdf(i, pdf, collection, test_id):
-            """
-            Process one PDF file at a time
-            Function to be used for parallel processing
-            :param i: Index of the PDF file
-            :param pdf: PDF file
-            :param collection: MongoDB collection
-            :param test_id: Test ID
-            :return: JSON response containing the student ID and answers
-            """
-            try:
-                # Preprocess the image and get the evaluation output
-                json_data = preprocess_image(collection, pdf, test_id)
-
-                # Transform the output to a Moodle happy output
-                db_data = collection.find_one({"test_id": test_id})
-                student_result, student_log = transform_eval_output(json_data, db_data)
-
-                # Skip if the student was not found in the database (most likely due to bad ID detection)
-                if student_result is None:
-                    err_msg = f"ERROR: Evaluation failed on page {i + 1}! Student with {json_data['student_id']} ID not found in the database! (ID detection failed)"
-                    err_dict = {"error": err_msg, "result": []}
-                    os.remove(pdf)
-                    return {"result": err_dict, "log": err_msg}
-
-                # Remove the temporary PDF
-                os.remove(pdf)
-
-                # Return the student result and log
-                return {"result": student_result, "log": student_log}
-            except Exception as e:
-                # On error, return an error message and remove the temporary PDF
-                err_msg = f"ERROR: Evaluation failed on page {i + 1}! {e}"
-                err_dict = {"error": err_msg, "result": []}
-                os.remove(pdf)
-                return {"result": err_dict, "log": err_msg}
-
-        # Process the PDFs in parallel
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(process_pdf, i, pdf, collection, test_id)
-                       for i, pdf in enumerate(pdf_names)]
-
-            # Get the results and logs
-            for future in futures:
-                output = future.result()
-                result.append(output["result"])
-                logs.append(output["log"])
-
-        log = "\n".join(logs)
-
-        return jsonify({"result": result, "log": log})
+        # Get the data from the request (the PDF stays in memory)
+        thumbnails = request.args.get("thumbnails", "0").lower() in ("1", "true")
+        if request.args.get("stream", "0").lower() in ("1", "true"):
+            return Response(stream_evaluation(request.data, thumbnails), mimetype="application/x-ndjson")
+        return jsonify(evaluate_pdf(request.data, thumbnails))
 
     return catch_errors(inner_func)()
 
 
+@app.route('/test_evaluation/jobs', methods=['POST'])
+def submit_evaluation_job():
+    """
+    Submit the PDF for the evaluation in the background
+    Query parameter thumbnails=1 adds the images of the bubbles to be checked by a human to the review list
+    :return: JSON response containing the job ID
+    """
+    if not request.data:
+        return jsonify({'error': 'No file part'})
+
+    def inner_func():
+        thumbnails = request.args.get("thumbnails", "0").lower() in ("1", "true")
+        job = job_queue.submit(evaluate_pdf, request.data, thumbnails)
+        return jsonify({"job_id": job.id}), 202
+
+    return catch_errors(inner_func)()
+
+
+@app.route('/test_evaluation/jobs/<job_id>', methods=['GET'])
+def get_evaluation_job(job_id):
+    """
+    Get the progress of the evaluation job (pages done and failed and the results of the students so far)
+    :param job_id: Job ID
+    :return: JSON response containing the job status
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/test_evaluation/jobs/<job_id>/result', methods=['GET'])
+def get_evaluation_job_result(job_id):
+    """
+    Get the result of the finished evaluation job (the same as the result of /test_evaluation)
+    :param job_id: Job ID
+    :return: JSON response containing the results or the job status if it is not finished yet
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status == "failed":
+        return jsonify({'error': job.error}), 500
+    if job.status != "done":
+        return jsonify(job.to_dict()), 202
+    return jsonify(job.result)
+
+
 if __name__ == '__main__':
-    # Create the directory for the generated PDFs if it does not exist
-    if not os.path.exists("generated_pdfs"):
-        os.makedirs("generated_pdfs")
+    # Load the QR code readers in the background, so the requests do not have to wait for the model
+    threading.Thread(target=warmup, daemon=True).start()
+    threading.Thread(target=warmup_page_workers, daemon=True).start()
+    # Indexes of the lookups by test ID (in the background, the start does not wait for MongoDB)
+    threading.Thread(target=ensure_indexes, args=(collection,), daemon=True).start()
 
     if os.environ.get('ENV') == 'production':
         app.run(host='0.0.0.0', port=8081)
@@ -0,0 +1,140 @@
+import time
+import uuid
+import queue
+import threading
+
+
+class Job:
+    """
+    Class representing a background job (e.g. evaluation of one scanned PDF)
+    """
+    def __init__(self, job_id):
+        """
+        Initialize the job
+        :param job_id: Job ID
+        """
+        self.id = job_id
+        self.status = "queued"  # queued -> running -> done / failed
+        self.pages_total = None
+        self.pages_done = 0
+        self.pages_failed = 0
+        self.partial_results = []
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def update_pages(self, pages_done, pages_failed, pages_total):
+        """
+        Update the progress of the pages
+        :param pages_done: Number of analysed pages
+        :param pages_failed: Number of pages that could not be read
+        :param pages_total: Number of all pages
+        """
+        with self.lock:
+            self.pages_done = pages_done
+            self.pages_failed = pages_failed
+            self.pages_total = pages_total
+
+    def add_partial_result(self, result):
+        """
+        Add the result of one student (available before the whole job is finished)
+        :param result: Result of the student
+        """
+        with self.lock:
+            self.partial_results.append(result)
+
+    def to_dict(self):
+        """
+        Convert the job status to a dictionary (without the final result)
+        :return: Dictionary representation of the job
+        """
+        with self.lock:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "pages_total": self.pages_total,
+                "pages_done": self.pages_done,
+                "pages_failed": self.pages_failed,
+                "partial_results": list(self.partial_results),
+                "error": self.error,
+            }
+
+
+class JobQueue:
+    """
+    In-process job queue processed by background threads (no external broker)
+    """
+    def __init__(self, workers=1, keep_seconds=3600):
+        """
+        Initialize the queue (the worker threads are started with the first job)
+        :param workers: Number of jobs processed at once
+        :param keep_seconds: How long the finished jobs are kept
+        """
+        self.workers = workers
+        self.keep_seconds = keep_seconds
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Submit a job
+        :param func: Function processing the job, called as func(*args, job=job, **kwargs), returns the result
+        :return: Job
+        """
+        job = Job(uuid.uuid4().hex)
+        with self.lock:
+            self.remove_old_jobs()
+            self.jobs[job.id] = job
+            # Start the workers
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+        self.queue.put((job, func, args, kwargs))
+        return job
+
+    def get(self, job_id):
+        """
+        Get the job
+        :param job_id: Job ID
+        :return: Job or None if it does not exist (or it was already removed)
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def remove_old_jobs(self):
+        """
+        Remove the jobs finished more than keep_seconds ago (the lock must be held)
+        """
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished is not None and now - job.finished > self.keep_seconds]:
+            del self.jobs[job_id]
+
+    def work(self):
+        """
+        Process the jobs one by one (worker thread)
+        """
+        while True:
+            job, func, args, kwargs = self.queue.get()
+            with job.lock:
+                job.status = "running"
+            try:
+                result = func(*args, job=job, **kwargs)
+                with job.lock:
+                    job.result = result
+                    job.status = "done"
+            except Exception as e:
+                print(f'An error occurred in job {job.id}: {e}')
+                with job.lock:
+                    job.error = f'An error occurred: {e}'
+                    job.status = "failed"
+            finally:
+                with job.lock:
+                    job.finished = time.time()
+                self.queue.task_done()
@@ -0,0 +1,272 @@
+import os
+import sys
+import time
+import argparse
+import fitz
+import cv2
+import numpy as np
+
+# Add the parent directory to the path
+sys.path.append(os.path.join(os.getcwd(), ".."))
+
+# Import the functions now that the path is set
+from ai.src.generator.bubble_sheet_generator import generate_bubble_sheet, get_sheet_layout, BubbleSheetTemplate
+from ai.src.evaluator.preprocessor import map_pages_to_students, group_pages_by_student, merge_page_answers
+from ai.src.evaluator.evaluator import AnswerKey
+from ai.src.generator.question_paper_generator import generate_question_paper, QuestionPaperRenderer
+from ai.src.utils import load_config
+
+
+def benchmark_bubble_sheets(num_of_students, num_of_q):
+    """
+    Compare the per-page matplotlib bubble sheet generation with the template based one
+    :param num_of_students: Number of students (bubble sheets)
+    :param num_of_q: Number of questions
+    """
+    test_id = "benchmark"
+    date = "1. 1. 2024"
+
+    # Matplotlib figure for every page of every student
+    start = time.perf_counter()
+    num_of_pages = 0
+    for student_id in range(num_of_students):
+        with generate_bubble_sheet(test_id, student_id, num_of_q, date, f"Student {student_id}") as doc:
+            num_of_pages += doc.page_count
+            doc.tobytes()
+    legacy_time = time.perf_counter() - start
+
+    # Template drawn once, students stamped on top of it
+    start = time.perf_counter()
+    template = BubbleSheetTemplate(test_id, num_of_q, date)
+    doc = fitz.open()
+    for student_id in range(num_of_students):
+        template.render(doc, student_id, f"Student {student_id}")
+    doc.subset_fonts()
+    doc.tobytes(garbage=3, deflate=True)
+    template_time = time.perf_counter() - start
+
+    print(f"Bubble sheets ({num_of_students} students, {num_of_q} questions, {num_of_pages} pages)")
+    print(f"  matplotlib: {legacy_time:.2f} s, {num_of_pages / legacy_time:.1f} pages/s")
+    print(f"  template:   {template_time:.2f} s, {num_of_pages / template_time:.1f} pages/s")
+
+
+class BenchmarkCollection:
+    """
+    In-memory stand-in for the MongoDB collection (only what the evaluation of the scans needs)
+    """
+    def __init__(self, test_id, num_of_q):
+        self.test = {"test_id": test_id, "num_of_questions": num_of_q}
+
+    def find_one(self, query, *args, **kwargs):
+        return self.test if query.get("test_id") == self.test["test_id"] else None
+
+
+def benchmark_question_papers(num_of_students, num_of_q):
+    """
+    Compare the question papers rendered by wkhtmltopdf (one process per student) with the native renderer
+    :param num_of_students: Number of students (question papers)
+    :param num_of_q: Number of questions
+    """
+    date = "1. 1. 2024"
+    questions = [f"(1b) Otázka {i}\nKolik je $$x^{i}$$, když <b>x</b> = 2?" for i in range(num_of_q)]
+    answers = [[str(2 ** i * j) for j in range(4)] for i in range(num_of_q)]
+    papers = [(student_id, questions, answers, date, f"Student {student_id}") for student_id in range(num_of_students)]
+
+    print(f"Question papers ({num_of_students} students, {num_of_q} questions)")
+
+    # One wkhtmltopdf process per student (only if it is installed)
+    try:
+        start = time.perf_counter()
+        num_of_pages = 0
+        for paper in papers:
+            with fitz.open(stream=generate_question_paper(*paper), filetype="pdf") as doc:
+                num_of_pages += doc.page_count
+        legacy_time = time.perf_counter() - start
+        print(f"  wkhtmltopdf: {legacy_time:.2f} s, {num_of_pages / legacy_time:.1f} pages/s")
+    except FileNotFoundError as e:
+        print(f"  wkhtmltopdf: skipped ({e})")
+
+    # All the papers laid out in this process
+    start = time.perf_counter()
+    doc = QuestionPaperRenderer().render(papers)
+    doc.tobytes(garbage=1, deflate=True)
+    native_time = time.perf_counter() - start
+    print(f"  native:      {native_time:.2f} s, {doc.page_count / native_time:.1f} pages/s")
+
+
+def make_scanned_pdf(test_id, num_of_students, num_of_q, scan_dpi=200, seed=0):
+    """
+    Create a synthetic scan of filled bubble sheets (random answers, slightly skewed pages with noise)
+    :param test_id: Test ID
+    :param num_of_students: Number of students
+    :param num_of_q: Number of questions
+    :param scan_dpi: Resolution of the "scanner"
+    :param seed: Random seed
+    :return: PDF file (bytes) and the filled answers of every student
+    """
+    config = load_config()
+    rng = np.random.default_rng(seed)
+    layout = get_sheet_layout(config, num_of_q)
+    rows = config["answer_rect"]["grid"]["rows"]
+    cols = config["answer_rect"]["grid"]["cols"]
+
+    template = BubbleSheetTemplate(test_id, num_of_q, "1. 1. 2024")
+    scan = fitz.open()
+    expected = {}
+    for student_id in range(num_of_students):
+        doc = fitz.open()
+        template.render(doc, student_id, f"Student {student_id}")
+        answers = (rng.random((num_of_q, cols)) < 0.3).astype(int)
+        expected[str(student_id).zfill(4)] = answers.tolist()
+
+        # Fill the answer bubbles
+        for q in range(num_of_q):
+            rect = q // rows
+            page = next(p for p in range(layout.num_of_pages) if rect < sum(layout.num_of_rects_in_page[:p + 1]))
+            box = layout.boxes[page][1 + rect - sum(layout.num_of_rects_in_page[:page])]  # Student ID box first
+            for col in np.flatnonzero(answers[q]):
+                center = template.to_pdf(page, *box.bubble_centers[q % rows, col])
+                doc[page].draw_circle(center, box.bubble_radius * template.transforms[page][0], color=(0, 0, 0), fill=(0, 0, 0))
+
+        # "Scan" the pages
+        for page in doc:
+            pixmap = page.get_pixmap(dpi=scan_dpi)
+            image = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.h, pixmap.w, pixmap.n)
+            rotation = cv2.getRotationMatrix2D((pixmap.w / 2, pixmap.h / 2), rng.uniform(-1, 1), 1)
+            image = cv2.warpAffine(image, rotation, (pixmap.w, pixmap.h), borderValue=(255, 255, 255))
+            image = np.clip(image + rng.integers(-12, 12, image.shape), 0, 255).astype(np.uint8)
+            scan_page = scan.new_page(width=page.rect.width, height=page.rect.height)
+            scan_page.insert_image(scan_page.rect, stream=cv2.imencode(".png", image)[1].tobytes())
+        doc.close()
+
+    return scan.tobytes(), expected
+
+
+def benchmark_scan_dpi(num_of_students, num_of_q, dpi_settings):
+    """
+    Compare the latency and the accuracy of the evaluation of the scans for different resolutions
+    :param num_of_students: Number of students (bubble sheets)
+    :param num_of_q: Number of questions
+    :param dpi_settings: List of (analysis, bubbles) resolutions
+    """
+    test_id = "benchmark"
+    pdf_data, expected = make_scanned_pdf(test_id, num_of_students, num_of_q)
+    collection = BenchmarkCollection(test_id, num_of_q)
+
+    print(f"Scan evaluation ({num_of_students} students, {num_of_q} questions)")
+    for dpi in dpi_settings:
+        start = time.perf_counter()
+        student_page_ids, _, page_answers = map_pages_to_students(collection, pdf_data, dpi)
+        results = [merge_page_answers(pages) for pages in group_pages_by_student(student_page_ids, page_answers)]
+        elapsed = time.perf_counter() - start
+
+        # Questions read exactly as they were filled
+        correct = sum(int(np.array_equal(read, filled))
+                      for result in results if result["student_id"] in expected
+                      for read, filled in zip(result["answers"], expected[result["student_id"]]))
+        print(f"  analysis {dpi[0]} dpi, bubbles {dpi[1]} dpi: {elapsed:.2f} s, "
+              f"{correct}/{num_of_students * num_of_q} questions correct")
+
+
+def benchmark_evaluation_scaling(num_of_students, num_of_q, max_processes):
+    """
+    Measure how the evaluation of the scans scales with the number of worker processes
+    :param num_of_students: Number of students (bubble sheets)
+    :param num_of_q: Number of questions
+    :param max_processes: Maximal number of worker processes
+    """
+    test_id = "benchmark"
+    pdf_data, _ = make_scanned_pdf(test_id, num_of_students, num_of_q)
+    collection = BenchmarkCollection(test_id, num_of_q)
+    num_of_pages = fitz.open(stream=pdf_data, filetype="pdf").page_count
+
+    # 1, 2, 4, ... and the maximum
+    process_counts = sorted({2 ** i for i in range(max_processes.bit_length()) if 2 ** i <= max_processes} | {max_processes})
+
+    print(f"Scan evaluation scaling ({num_of_students} students, {num_of_pages} pages)")
+    start = time.perf_counter()
+    map_pages_to_students(collection, pdf_data, processes=0)
+    threads_time = time.perf_counter() - start
+    print(f"  threads:      {threads_time:.2f} s, {num_of_pages / threads_time:.1f} pages/s")
+    for processes in process_counts:
+        # The first run starts the workers and loads their QR code readers, it is not measured
+        map_pages_to_students(collection, pdf_data, processes=processes)
+        start = time.perf_counter()
+        map_pages_to_students(collection, pdf_data, processes=processes)
+        elapsed = time.perf_counter() - start
+        print(f"  {processes:2d} processes: {elapsed:.2f} s, {num_of_pages / elapsed:.1f} pages/s, "
+              f"speedup {threads_time / elapsed:.2f}x")
+
+
+def make_cohort(num_of_students, num_of_q, num_of_options=5, seed=0):
+    """
+    Create a synthetic test (shuffled for every student) and random answers of the students
+    :param num_of_students: Number of students
+    :param num_of_q: Number of questions
+    :param num_of_options: Number of answers of every question
+    :param seed: Random seed
+    :return: Test data (as saved in the database), IDs of the students and their answers
+             (student x printed row x printed column)
+    """
+    rng = np.random.default_rng(seed)
+    fractions = ["100", "-50", "0", "33.33333", "-33.33333", "50"]
+    questions = [{"name": f"Q{i}", "text": f"Question {i}", "default_grade": str(rng.integers(1, 4)),
+                  "answers": [{"text": chr(65 + j), "fraction": str(rng.choice(fractions))}
+                              for j in range(num_of_options)]}
+                 for i in range(num_of_q)]
+    students = []
+    for student_id in range(num_of_students):
+        shuffle = [{"question": int(i), "answers": rng.permutation(num_of_options).tolist()}
+                   for i in rng.permutation(num_of_q)]
+        students.append({"id": student_id, "name": "Jan", "surname": "Novák", "student_number": f"A{student_id}",
+                         "username": f"user{student_id}", "email": "", "shuffle": shuffle})
+
+    answers = rng.random((num_of_students, num_of_q, num_of_options)) < 0.3
+    return {"gc": False, "questions": questions, "students": students}, list(range(num_of_students)), answers
+
+
+def benchmark_batch_scoring(cohort_sizes, num_of_q):
+    """
+    Compare scoring the students one by one with scoring the whole class at once
+    :param cohort_sizes: Numbers of students
+    :param num_of_q: Number of questions
+    """
+    print(f"Scoring ({num_of_q} questions)")
+    for num_of_students in cohort_sizes:
+        db_data, student_ids, answers = make_cohort(num_of_students, num_of_q)
+
+        start = time.perf_counter()
+        answer_key = AnswerKey(db_data)
+        compile_time = time.perf_counter() - start
+
+        # One student at a time
+        start = time.perf_counter()
+        points = [answer_key.score(student_id, student_answers)[2]
+                  for student_id, student_answers in zip(student_ids, answers)]
+        single_time = time.perf_counter() - start
+
+        # Whole class in one pass
+        start = time.perf_counter()
+        _, _, batch_points, _ = answer_key.score_batch(student_ids, answers)
+        batch_time = time.perf_counter() - start
+
+        assert np.array_equal(np.array(points), batch_points)
+        print(f"  {num_of_students} students: answer key {compile_time:.3f} s, "
+              f"one by one {single_time:.3f} s, batch {batch_time:.3f} s ({single_time / batch_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the AI service (run from the ai directory)")
+    parser.add_argument("--students", type=int, default=30, help="Number of students")
+    parser.add_argument("--questions", type=int, default=45, help="Number of questions")
+    parser.add_argument("--scan-students", type=int, default=10, help="Number of students in the scan benchmark")
+    parser.add_argument("--cohorts", type=int, nargs="+", default=[1000, 10000],
+                        help="Numbers of students in the scoring benchmark")
+    parser.add_argument("--max-processes", type=int, default=os.cpu_count(), help="Maximal number of worker processes")
+    args = parser.parse_args()
+
+    benchmark_bubble_sheets(args.students, args.questions)
+    benchmark_question_papers(args.students, args.questions)
+    benchmark_scan_dpi(args.scan_students, args.questions, [(300, 300), (150, 300), (100, 300), (150, 200)])
+    benchmark_evaluation_scaling(args.scan_students, args.questions, args.max_processes)
+    benchmark_batch_scoring(args.cohorts, args.questions)
@@ -0,0 +1,267 @@
+import os
+import threading
+from collections import deque
+from pymongo import MongoClient, monitoring
+
+# Settings of the MongoDB client (key in the "database" section of config.json -> MongoClient option)
+# Every setting can be overridden by the environment variable MONGO_<KEY>, e.g. MONGO_MAX_POOL_SIZE
+CLIENT_SETTINGS = {
+    "max_pool_size": ("maxPoolSize", int),
+    "wait_queue_timeout_ms": ("waitQueueTimeoutMS", int),
+    "server_selection_timeout_ms": ("serverSelectionTimeoutMS", int),
+    "connect_timeout_ms": ("connectTimeoutMS", int),
+    "socket_timeout_ms": ("socketTimeoutMS", int),
+    "read_preference": ("readPreference", str),
+}
+
+# Number of the latest queries the percentiles are computed from
+LATENCY_WINDOW = 1000
+
+
+class LatencyStats:
+    """
+    Latencies of the database queries (by command) and the usage of the connection pool
+    """
+    def __init__(self):
+        """
+        Initialize the statistics
+        """
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.connections_in_use = 0
+        self.max_connections_in_use = 0
+        self.checkout_failed = 0
+        self.checkout_waits = deque(maxlen=LATENCY_WINDOW)
+
+    def add_query(self, command, duration_ms, failed=False):
+        """
+        Add the finished query
+        :param command: Name of the command (find, insert, ...)
+        :param duration_ms: Duration of the query in milliseconds
+        :param failed: True if the query failed
+        """
+        with self.lock:
+            stats = self.commands.setdefault(command, {"count": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                       "latest_ms": deque(maxlen=LATENCY_WINDOW)})
+            stats["count"] += 1
+            stats["failed"] += failed
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["latest_ms"].append(duration_ms)
+
+    def connection_checked_out(self, wait_ms=None):
+        """
+        Count the connection taken from the pool
+        :param wait_ms: How long the thread waited for the connection in milliseconds (if known)
+        """
+        with self.lock:
+            self.connections_in_use += 1
+            self.max_connections_in_use = max(self.max_connections_in_use, self.connections_in_use)
+            if wait_ms is not None:
+                self.checkout_waits.append(wait_ms)
+
+    def connection_checked_in(self):
+        """
+        Count the connection returned to the pool
+        """
+        with self.lock:
+            self.connections_in_use -= 1
+
+    def checkout_failure(self):
+        """
+        Count the failed attempt to get a connection (e.g. the pool wait queue timed out)
+        """
+        with self.lock:
+            self.checkout_failed += 1
+
+    def to_dict(self):
+        """
+        Convert the statistics to a dictionary
+        :return: Query latencies by command (count, failed, mean, p50, p95, max) and the pool usage
+        """
+        with self.lock:
+            commands = {}
+            for command, stats in self.commands.items():
+                latest = sorted(stats["latest_ms"])
+                commands[command] = {
+                    "count": stats["count"],
+                    "failed": stats["failed"],
+                    "mean_ms": round(stats["total_ms"] / stats["count"], 2),
+                    "p50_ms": round(percentile(latest, 0.5), 2),
+                    "p95_ms": round(percentile(latest, 0.95), 2),
+                    "max_ms": round(stats["max_ms"], 2),
+                }
+            waits = sorted(self.checkout_waits)
+            return {
+                "queries": commands,
+                "pool": {
+                    "in_use": self.connections_in_use,
+                    "max_in_use": self.max_connections_in_use,
+                    "checkout_failed": self.checkout_failed,
+                    "checkout_wait_p95_ms": round(percentile(waits, 0.95), 2),
+                    "checkout_wait_max_ms": round(waits[-1], 2) if waits else 0,
+                },
+            }
+
+
+def percentile(values, q):
+    """
+    Percentile of the sorted values (nearest rank)
+    :param values: Sorted values
+    :param q: Percentile (0 - 1)
+    :return: Percentile, 0 if there are no values
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class QueryListener(monitoring.CommandListener):
+    """
+    Record the latency of every database command
+    """
+    def __init__(self, stats):
+        """
+        Initialize the listener
+        :param stats: Statistics the latencies are recorded to (LatencyStats)
+        """
+        self.stats = stats
+
+    def started(self, event):
+        """
+        Command started - nothing is recorded, the duration is known when the command finishes
+        :param event: CommandStartedEvent
+        """
+        pass
+
+    def succeeded(self, event):
+        """
+        Record the latency of the finished command
+        :param event: CommandSucceededEvent
+        """
+        self.stats.add_query(event.command_name, event.duration_micros / 1000)
+
+    def failed(self, event):
+        """
+        Record the latency of the failed command
+        :param event: CommandFailedEvent
+        """
+        self.stats.add_query(event.command_name, event.duration_micros / 1000, failed=True)
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """
+    Record the usage of the connection pool (connections in use and the time waited for a connection)
+    Only the checkouts are recorded, the other events of the pool are ignored
+    """
+    def __init__(self, stats):
+        """
+        Initialize the listener
+        :param stats: Statistics the pool usage is recorded to (LatencyStats)
+        """
+        self.stats = stats
+
+    def connection_checked_out(self, event):
+        """
+        Record the connection taken from the pool and how long the thread waited for it
+        :param event: ConnectionCheckedOutEvent
+        """
+        # The duration of the checkout is reported by newer versions of pymongo only
+        duration = getattr(event, "duration", None)
+        self.stats.connection_checked_out(duration * 1000 if duration is not None else None)
+
+    def connection_checked_in(self, event):
+        """
+        Record the connection returned to the pool
+        :param event: ConnectionCheckedInEvent
+        """
+        self.stats.connection_checked_in()
+
+    def connection_check_out_failed(self, event):
+        """
+        Record the failed attempt to get a connection
+        :param event: ConnectionCheckOutFailedEvent
+        """
+        self.stats.checkout_failure()
+
+    def pool_created(self, event):
+        """
+        Ignored (the pool was created)
+        :param event: PoolCreatedEvent
+        """
+        pass
+
+    def pool_ready(self, event):
+        """
+        Ignored (the pool is ready)
+        :param event: PoolReadyEvent
+        """
+        pass
+
+    def pool_cleared(self, event):
+        """
+        Ignored (the connections of the pool were closed, e.g. after a network error)
+        :param event: PoolClearedEvent
+        """
+        pass
+
+    def pool_closed(self, event):
+        """
+        Ignored (the pool was closed)
+        :param event: PoolClosedEvent
+        """
+        pass
+
+    def connection_created(self, event):
+        """
+        Ignored (a new connection was created)
+        :param event: ConnectionCreatedEvent
+        """
+        pass
+
+    def connection_ready(self, event):
+        """
+        Ignored (the new connection is ready to be used)
+        :param event: ConnectionReadyEvent
+        """
+        pass
+
+    def connection_closed(self, event):
+        """
+        Ignored (a connection was closed)
+        :param event: ConnectionClosedEvent
+        """
+        pass
+
+    def connection_check_out_started(self, event):
+        """
+        Ignored (a thread started waiting for a connection, the wait is recorded when the checkout finishes)
+        :param event: ConnectionCheckOutStartedEvent
+        """
+        pass
+
+
+def load_client_settings(config):
+    """
+    Get the options of the MongoDB client from the config and the environment variables (they take precedence)
+    :param config: Configuration (the "database" section is used)
+    :return: Dictionary of the MongoClient options
+    """
+    settings = {}
+    for key, (option, value_type) in CLIENT_SETTINGS.items():
+        value = os.environ.get(f"MONGO_{key.upper()}", config["database"].get(key))
+        if value is not None:
+            settings[option] = value_type(value)
+    return settings
+
+
+def create_client(uri, config, stats):
+    """
+    Create the MongoDB client (does not wait for the connection, the service starts even if MongoDB is unreachable)
+    :param uri: MongoDB URI
+    :param config: Configuration (see load_client_settings)
+    :param stats: Statistics the query latencies and the pool usage are recorded to (LatencyStats)
+    :return: MongoClient
+    """
+    return MongoClient(uri, connect=False, event_listeners=[QueryListener(stats), PoolListener(stats)],
+                       **load_client_settings(config))
@@ -0,0 +1,169 @@
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError, DuplicateKeyError, BulkWriteError
+
+# Split layout: the test document keeps only the header (questions, settings), every student is a separate
+# document in this collection (name of the tests collection + suffix) keyed by (test_id, id)
+STUDENTS_COLLECTION_SUFFIX = "_students"
+SPLIT_LAYOUT = "split"
+
+
+def students_collection(collection):
+    """
+    Get the collection with the students of the tests saved in the split layout
+    :param collection: DB collection of the tests
+    :return: DB collection of the students
+    """
+    return collection.database[collection.name + STUDENTS_COLLECTION_SUFFIX]
+
+
+def ensure_indexes(collection):
+    """
+    Create the indexes used by the lookups (nothing happens if they already exist)
+    Errors are only printed, the service works without the indexes (just slower)
+    :param collection: DB collection of the tests
+    :return: True if the indexes exist
+    """
+    try:
+        collection.create_index([("test_id", ASCENDING)], name="test_id")
+        students_collection(collection).create_index([("test_id", ASCENDING), ("id", ASCENDING)],
+                                                     name="test_id_student_id", unique=True)
+    except PyMongoError as e:
+        print(f"ERROR: Could not create the database indexes: {e}")
+        return False
+    return True
+
+
+def save_test(collection, test_id, gc, num_of_questions, students, questions, split_layout=False, date=None):
+    """
+    Save the test to the database
+    :param collection: DB collection of the tests
+    :param test_id: Test ID
+    :param gc: True if the data come from Google Classroom (not Moodle)
+    :param num_of_questions: Number of questions
+    :param students: Students (dictionaries, see Student.to_dict)
+    :param questions: Questions (dictionaries, see Question.to_dict)
+    :param split_layout: If true, every student is saved as a separate document with the shuffle as integer arrays,
+                         otherwise everything is embedded in one document
+    :param date: Date of the test as printed on the sheets (needed to print the sheets of the test again)
+    """
+    header = {
+        "test_id": test_id,
+        "gc": gc,
+        "num_of_questions": num_of_questions,
+        "questions": questions,
+        "date": date
+    }
+
+    if not split_layout:
+        collection.insert_one(dict(header, students=students))
+        return
+
+    if len(students) > 0:
+        students_collection(collection).insert_many([compact_student(test_id, student) for student in students])
+    # The header is saved last, the test is not found until all of its students are saved
+    collection.insert_one(dict(header, layout=SPLIT_LAYOUT))
+
+
+def compact_student(test_id, student):
+    """
+    Convert the student to the document of the split layout
+    :param test_id: Test ID
+    :param student: Student (dictionary, see Student.to_dict)
+    :return: Document with the shuffle as integer arrays (question order and answer orders)
+    """
+    document = {key: value for key, value in student.items() if key != "shuffle"}
+    document["test_id"] = test_id
+    document["questions"] = [obj["question"] for obj in student["shuffle"]]
+    document["answers"] = [obj["answers"] for obj in student["shuffle"]]
+    return document
+
+
+def expand_student(document):
+    """
+    Convert the document of the split layout back to the student (dictionary, see Student.to_dict)
+    :param document: Document of the student
+    :return: Student
+    """
+    student = {key: value for key, value in document.items() if key not in ("test_id", "questions", "answers")}
+    student["shuffle"] = [{"question": question, "answers": answers}
+                          for question, answers in zip(document["questions"], document["answers"])]
+    return student
+
+
+def find_test(collection, test_id, projection):
+    """
+    Find the test (in any of the layouts), only the fields in the projection are fetched
+    :param collection: DB collection of the tests
+    :param test_id: Test ID
+    :param projection: Fields to fetch (MongoDB projection with included fields)
+    :return: Test document (students embedded if requested) or None if the test does not exist
+    """
+    test = collection.find_one({"test_id": test_id}, dict(projection, layout=1))
+    if test is None:
+        return None
+
+    if test.pop("layout", None) == SPLIT_LAYOUT and projection.get("students"):
+        cursor = students_collection(collection).find({"test_id": test_id}, {"_id": 0}).sort("id", ASCENDING)
+        test["students"] = [expand_student(document) for document in cursor]
+
+    return test
+
+
+def find_students(collection, test_id, student_ids):
+    """
+    Find some of the students of the test (in any of the layouts) and the first unused student ID
+    :param collection: DB collection of the tests
+    :param test_id: Test ID
+    :param student_ids: IDs of the students to find
+    :return: Found students by ID (see Student.to_dict) and the next free student ID, None if the test does not exist
+    """
+    test = collection.find_one({"test_id": test_id}, {"_id": 0, "layout": 1})
+    if test is None:
+        return None
+
+    if test.get("layout") == SPLIT_LAYOUT:
+        students = students_collection(collection)
+        cursor = students.find({"test_id": test_id, "id": {"$in": list(student_ids)}}, {"_id": 0})
+        found = {document["id"]: expand_student(document) for document in cursor}
+        last = students.find_one({"test_id": test_id}, {"_id": 0, "id": 1}, sort=[("id", DESCENDING)])
+        return found, last["id"] + 1 if last is not None else 0
+
+    # Embedded layout - all the students are in the test document anyway
+    students = collection.find_one({"test_id": test_id}, {"_id": 0, "students": 1}).get("students", [])
+    found = {student["id"]: student for student in students if student["id"] in student_ids}
+    return found, max((student["id"] for student in students), default=-1) + 1
+
+
+def save_students(collection, test_id, students, new_ids):
+    """
+    Add new students to the saved test or replace the saved ones (matched by the ID)
+    :param collection: DB collection of the tests
+    :param test_id: Test ID
+    :param students: Students (dictionaries, see Student.to_dict)
+    :param new_ids: IDs of the students which are not saved yet
+    :raise ValueError: If a new student ID is already used (e.g. by a concurrent request)
+    """
+    test = collection.find_one({"test_id": test_id}, {"_id": 0, "layout": 1})
+    new_students = [student for student in students if student["id"] in new_ids]
+    changed_students = [student for student in students if student["id"] not in new_ids]
+
+    if test.get("layout") == SPLIT_LAYOUT:
+        documents = students_collection(collection)
+        for student in changed_students:
+            documents.replace_one({"test_id": test_id, "id": student["id"]}, compact_student(test_id, student))
+        if len(new_students) > 0:
+            try:
+                # The unique index (see ensure_indexes) rejects the IDs already used
+                documents.insert_many([compact_student(test_id, student) for student in new_students])
+            except (DuplicateKeyError, BulkWriteError) as e:
+                raise ValueError(f"Student ID is already used in test {test_id}: {e}")
+        return
+
+    for student in changed_students:
+        collection.update_one({"test_id": test_id, "students.id": student["id"]}, {"$set": {"students.$": student}})
+    for student in new_students:
+        # Only pushed if the ID is not used yet (checked atomically with the update)
+        result = collection.update_one({"test_id": test_id, "students.id": {"$ne": student["id"]}},
+                                       {"$push": {"students": student}})
+        if result.matched_count == 0:
+            raise ValueError(f"Student ID {student['id']} is already used in test {test_id}")
@@ -1,34 +1,142 @@
 import numpy as np
 
 from ai.src.utils import load_config
+from ai.src.db.quiz_store import find_test
+from ai.src.evaluator.preprocessor import bubble_confidence, REVIEW_CONFIDENCE
 
+# Fields of the test document needed for the scoring (the rest of the document is not fetched)
+TEST_PROJECTION = {"_id": 0, "gc": 1, "questions": 1, "students": 1}
 
-def transform_eval_output(json_data, db_data):
+
+def load_test(collection, test_id):
+    """
+    Load the test from the database once per evaluation (not for every student)
+    :param collection: DB collection
+    :param test_id: Test ID
+    :return: Data from the database (only the fields in TEST_PROJECTION) and its answer key,
+             or None, None if the test does not exist
+    """
+    db_data = find_test(collection, test_id, TEST_PROJECTION)
+    if db_data is None:
+        return None, None
+    return db_data, AnswerKey(db_data)
+
+
+class AnswerKey:
+    """
+    Answer key of the test compiled once for all the students
+    Holds the students indexed by their ID, the undo shuffle tables of every student and the fractions
+    of the answers as NumPy arrays, so scoring a student is a few array operations
+    """
+    def __init__(self, db_data):
+        """
+        Compile the answer key
+        :param db_data: Data from the database
+        """
+        self.questions = db_data["questions"]
+        self.students_by_id = {student["id"]: student for student in db_data["students"]}
+        # Position of the student in the undo shuffle tables
+        self.student_index = {student_id: k for k, student_id in enumerate(self.students_by_id)}
+
+        # Check if the GC penalty is enabled (aka if the import used is Moodle or GC)
+        self.gc_multiplier = 1
+        if "gc" in db_data.keys() and db_data["gc"]:
+            config = load_config()
+            self.gc_multiplier = config["gc_multiplier"]
+
+        # Points of the questions
+        self.grades = np.array([float(question["default_grade"]) for question in self.questions])
+        self.overall_points = 0
+        for grade in self.grades.tolist():
+            self.overall_points += grade
+
+        shuffles = [student["shuffle"] for student in self.students_by_id.values()]
+        num_of_options = max([len(question["answers"]) for question in self.questions] +
+                             [len(obj["answers"]) for shuffle in shuffles for obj in shuffle] + [1])
+
+        # Fractions of the answers (question x answer), missing answers are worth nothing
+        self.fractions = np.zeros((len(self.questions), num_of_options))
+        for i, question in enumerate(self.questions):
+            for j, answer in enumerate(question["answers"]):
+                self.fractions[i, j] = float(answer["fraction"])
+
+        # Undo shuffle (student x question): printed row of the question,
+        # (student x question x answer): printed column of the answer and whether the answer was printed at all
+        # Shuffle is a list of dictionaries, where each dictionary contains the question number and shuffled answers
+        shape = (len(shuffles), len(self.questions))
+        self.rows = np.argsort(np.array([[obj["question"] for obj in shuffle] for shuffle in shuffles],
+                                        dtype=np.intp).reshape(shape), axis=1)
+        lengths = np.array([[len(obj["answers"]) for obj in shuffle] for shuffle in shuffles],
+                           dtype=np.intp).reshape(shape)
+        printed = np.arange(num_of_options) < lengths[:, :, None]
+        # Answer shuffles padded with a value behind all the answers, so the padding stays at the end after argsort
+        answer_shuffles = np.full(printed.shape, num_of_options, dtype=np.intp)
+        answer_shuffles[printed] = [answer for shuffle in shuffles for obj in shuffle for answer in obj["answers"]]
+        cols = np.take_along_axis(np.argsort(answer_shuffles, axis=2), self.rows[:, :, None], axis=1)
+        self.printed = np.take_along_axis(printed, self.rows[:, :, None], axis=1)
+        self.cols = np.where(self.printed, cols, 0)
+
+    def score(self, student_id, student_answers):
+        """
+        Score the answers of one student
+        :param student_id: Student ID
+        :param student_answers: Marked bubbles of the student (printed row x printed column)
+        :return: Marked answers in the original order (question x answer), points of every question and the points
+                 of the student
+        """
+        marked, question_points, points, _ = self.score_batch([student_id], [student_answers])
+        return marked[0], question_points[0], points[0]
+
+    def score_batch(self, student_ids, answers):
+        """
+        Score the answers of many students (e.g. the whole class) at once
+        :param student_ids: IDs of the students
+        :param answers: Marked bubbles (student x printed row x printed column)
+        :return: Marked answers in the original order (student x question x answer), points of every question
+                 (student x question), points of every student and points relative to the maximum (rounded)
+        """
+        index = np.array([self.student_index[student_id] for student_id in student_ids], dtype=np.intp)
+        answers = np.asarray(answers, dtype=bool)
+        students = np.arange(len(index))[:, None, None]
+        marked = answers[students, self.rows[index][:, :, None], self.cols[index]] & self.printed[index]
+
+        fraction = (marked * self.fractions).sum(axis=2)
+        # GC penalty can be lowered, because the points are in range <-max; max> by default
+        # if gc_multiplier is 1, it does not change anything, otherwise it scales accordingly (0 is the other extreme)
+        fraction *= self.gc_multiplier
+
+        # Fraction is in range <-100; 100>, so we need to scale it to <-1; 1>
+        question_points = self.grades * np.round(fraction / 100, 2)
+        # Added question by question (cumsum), so the rounding is the same as when the points are added one by one
+        points = np.cumsum(question_points, axis=1)[:, -1] if len(self.questions) > 0 else np.zeros(len(index))
+
+        return marked, question_points, points, np.round(points / self.overall_points, 2)
+
+
+def transform_eval_output(json_data, db_data, answer_key=None):
     """
     Transform the evaluation output to a Moodle happy output
     :param json_data: Evaluation output
     :param db_data: Data from the database
-    :return: JSON response containing the student ID and answers
+    :param answer_key: Answer key of the test (see load_test), if None, it is compiled here
+    :return: JSON response containing the student ID and answers (with the fill ratios and the confidence of every
+             question and the list of the bubbles to be checked by a human under the "review" key)
     """
+    if answer_key is None:
+        answer_key = AnswerKey(db_data)
+
     # Get the data from the JSON and the database
     student_id = int(json_data["student_id"])
-    questions = db_data["questions"]
+    questions = answer_key.questions
     student_answers = json_data["answers"]
-    student_dict = {}
-    for student in db_data["students"]:
-        if student["id"] == student_id:
-            student_dict = student
+    fill_ratios = json_data["fill_ratios"]
+    thumbnails = json_data.get("thumbnails", {})
+    student_dict = answer_key.students_by_id.get(student_id, {})
 
     # Check if the student was found in the database (most likely due to bad ID detection)
     if "name" not in student_dict.keys():
         return None, None
 
-    # Check if the GC penalty is enabled (aka if the import used is Moodle or GC)
-    gc_multiplier = 1
-    if "gc" in db_data.keys() and db_data["gc"]:
-        config = load_config()
-        gc_multiplier = config["gc_multiplier"]
-
     # Prepare the result and log
     result = {
         "jmeno": student_dict["name"],
@@ -36,7 +144,8 @@ def transform_eval_output(json_data, db_data):
         "os_cislo": student_dict["student_number"],
         "login": student_dict["username"],
         "email": student_dict["email"],
-        "result": []
+        "result": [],
+        "review": []
     }
 
     log = f"Student: {student_dict['name']} {student_dict['surname']}; {student_dict['username']}; {student_dict['student_number']}\n"
@@ -50,65 +159,38 @@ def transform_eval_output(json_data, db_data):
     # Throw away the last "; "
     log = log[:-2]
 
-    # Undo shuffle
-    shuffle = student_dict["shuffle"]
-    question_undo_shuffle = []
-    answers_undo_shuffles = []
-    # Shuffle is a list of dictionaries, where each dictionary contains the question number and shuffled answers
-    for obj in shuffle:
-        question_undo_shuffle.append(obj["question"])
-        answers_undo_shuffles.append(obj["answers"])
-    # Sort the questions and answers according to the shuffle
-    question_undo_shuffle = np.argsort(question_undo_shuffle)
-    answers_undo_shuffles = [np.argsort(answers) for answers in answers_undo_shuffles]
-
-    # Undo the shuffle
-    unshuffled_answer_arrays = [student_answers[i] for i in question_undo_shuffle]
-    answers_undo_shuffles = [answers_undo_shuffles[i] for i in question_undo_shuffle]
-
-    # Prepare the final answers
-    final_answers = []
-    for i, answer_array in enumerate(unshuffled_answer_arrays):
-        unshuffled_answers = [answer_array[j] for j in answers_undo_shuffles[i]]
-        final_answers.append(unshuffled_answers)
-
-    # Calculate the points (evaluation starts here)
-    points = 0
-    overall_points = 0
+    # Undo the shuffle and calculate the points (evaluation starts here)
+    marked, question_points, points = answer_key.score(student_id, student_answers)
+    k = answer_key.student_index[student_id]
 
     for i, question in enumerate(questions):
-        # Get the question points and correct answers
-        question_points = float(question["default_grade"])
-        correct_answers = question["answers"]
-        answers = final_answers[i]
-
-        overall_points += question_points
-        fraction = 0
-
         obj = {"question": {"name": question["name"], "text": question["text"]}, "answer": []}
-        for j, answer in enumerate(answers):
-            if answer == 1:
-                try:
-                    obj["answer"].append(chr(65 + j))
-                    # obj["answer"].append(correct_answers[j]["text"])
-                    fraction += float(correct_answers[j]["fraction"])
-                except IndexError:
-                    pass
-
-        # GC penalty can be lowered, because the points are in range <-max; max> by default
-        # if gc_multiplier is 1, it does not change anything, otherwise it scales accordingly (0 is the other extreme)
-        fraction *= gc_multiplier
 
-        # Fraction is in range <-100; 100>, so we need to scale it to <-1; 1>
-        question_points *= np.round((fraction / 100), 2)
-        points += question_points
-        obj["points"] = question_points
+        # Fill ratios of the bubbles of the answers (printed row and columns of the question)
+        row = answer_key.rows[k, i]
+        cols = answer_key.cols[k, i][answer_key.printed[k, i]]
+        ratios = [fill_ratios[row][col] for col in cols]
+        confidence = bubble_confidence(ratios)
+        obj["fill_ratios"] = ratios
+        obj["confidence"] = float(np.round(confidence.min(), 2)) if len(ratios) > 0 else 1.0
+
+        # Only the unclear bubbles are checked by a human
+        for j, col in enumerate(cols):
+            if confidence[j] < REVIEW_CONFIDENCE:
+                review_item = {"question": i + 1, "name": question["name"], "answer": chr(65 + j),
+                               "fill_ratio": ratios[j], "confidence": float(np.round(confidence[j], 2))}
+                if col in thumbnails.get(row, {}):
+                    review_item["thumbnail"] = thumbnails[row][col]
+                result["review"].append(review_item)
+
+        obj["answer"] = [chr(65 + j) for j in np.flatnonzero(marked[i])]
+        obj["points"] = question_points[i]
 
         result["result"].append(obj)
 
     # Add the final points to the result
     result["body"] = np.round(points, 2)
-    result["body_celkem"] = overall_points
-    result["body_rel"] = np.round(points / overall_points, 2)
+    result["body_celkem"] = answer_key.overall_points
+    result["body_rel"] = np.round(points / answer_key.overall_points, 2)
 
     return result, log
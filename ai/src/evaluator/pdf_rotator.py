@@ -1,25 +1,46 @@
+import threading
 import fitz
 import numpy as np
 import cv2
+from deskew import determine_skew
 
+# PyMuPDF is not thread safe, every rendering goes through this lock
+render_lock = threading.Lock()
 
-def load_pdf(file_path):
+
+def pixmap_to_image(pixmap):
     """
-    Load pdf file and return list of images
-    If nessesary, rotate images
-    :param file_path: Path to pdf file
-    :return: List of (rotated) images
+    Convert the pixmap to a numpy array (RGB image)
+    :param pixmap: Pixmap (fitz)
+    :return: Image
     """
-    pdf = fitz.open(file_path)
-    images = []
-    for page_num in range(len(pdf)):  # Iterate over all pages
-        page = pdf[page_num]
-        image = page.get_pixmap(dpi=300)
-        if image.h > image.w:
-            image = np.frombuffer(image.samples, dtype=np.uint8).reshape(image.h, image.w, 3)  # Convert to numpy array
+    return np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.h, pixmap.w, pixmap.n)
+
+
+class ScannedPage:
+    """
+    Scanned page rendered (and rotated) in a low resolution
+    Parts of the page (boxes with bubbles) can be rendered again in a higher resolution
+    """
+    def __init__(self, page, dpi):
+        """
+        Render the page and rotate it if nessesary
+        :param page: Page of the PDF file (fitz)
+        :param dpi: Resolution of the page image
+        """
+        self.page = page
+        self.dpi = dpi
+
+        with render_lock:
+            image = pixmap_to_image(page.get_pixmap(dpi=dpi))
+        height, width, _ = image.shape
+
+        # Page coordinates -> image coordinates (the rotations of the image are added below)
+        self.matrix = fitz.Matrix(dpi / 72, dpi / 72)
+
+        if height > width:
             image = np.rot90(image)  # Rotate image 90 degrees
-        else:
-            image = np.frombuffer(image.samples, dtype=np.uint8).reshape(image.h, image.w, 3)
+            self.matrix *= fitz.Matrix(0, -1, 1, 0, 0, width)
         # Check if there is a rectangle in the top right corner
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         gray = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY)[1]
@@ -36,7 +57,78 @@ def load_pdf(file_path):
                 rotate = False
         if rotate:
             image = np.rot90(image, 2)  # Rotate image 180 degrees
+            self.matrix *= fitz.Matrix(-1, 0, 0, -1, width, height)
+
+        self.image = image
+        # Deskew rotation (image -> deskewed image)
+        self.deskew_matrix = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+        # Skew angle (None until the page is deskewed)
+        self.angle = None
 
-        images.append(image)
+    def deskew(self):
+        """
+        Detect the skew of the page and rotate the image accordingly (only once)
+        :return: Skew angle (in degrees)
+        """
+        if self.angle is not None:
+            return self.angle
 
-    return images
+        skew_detect_img = self.image[:int(self.image.shape[0] * 0.5), :int(self.image.shape[1] * 0.5)]
+        angle = determine_skew(skew_detect_img)
+        self.angle = angle if angle is not None else 0
+        if self.angle != 0:
+            h, w = self.image.shape[:2]
+            self.deskew_matrix = cv2.getRotationMatrix2D((w // 2, h // 2), self.angle, 1)
+            self.image = cv2.warpAffine(self.image, self.deskew_matrix, (w, h), flags=cv2.INTER_LINEAR)
+
+        return self.angle
+
+    def crop(self, x, y, w, h, dpi):
+        """
+        Get a part of the (deskewed) page image
+        If the resolution is higher than the one of the page image, only this part is rendered again
+        :param x: The x-coordinate of the top left corner (deskewed image coordinates)
+        :param y: The y-coordinate of the top left corner (deskewed image coordinates)
+        :param w: Width (deskewed image coordinates)
+        :param h: Height (deskewed image coordinates)
+        :param dpi: Resolution of the result
+        :return: Image of the part of the page
+        """
+        if dpi <= self.dpi:
+            return self.image[y:y + h, x:x + w]
+
+        # Deskewed image -> image -> page coordinates
+        corners = np.array([[[x, y], [x + w, y], [x, y + h], [x + w, y + h]]], dtype=np.float64)
+        corners = cv2.transform(corners, cv2.invertAffineTransform(self.deskew_matrix))[0]
+        to_page = ~self.matrix
+        page_corners = [fitz.Point(corner) * to_page for corner in corners]
+        clip = fitz.Rect(page_corners[0], page_corners[0])
+        for corner in page_corners[1:]:
+            clip |= corner
+
+        # Page coordinates -> image in the higher resolution -> deskewed (rotation only, the origin does not matter)
+        scale = dpi / self.dpi
+        (a, c, _), (b, d, _) = self.deskew_matrix
+        matrix = self.matrix * fitz.Matrix(scale, scale) * fitz.Matrix(a, b, c, d, 0, 0)
+
+        with render_lock:
+            pixmap = self.page.get_pixmap(matrix=matrix, clip=clip)
+            image = pixmap_to_image(pixmap)
+
+        # Position of the part in the rendered clip
+        device_corners = [corner * matrix for corner in page_corners]
+        x0 = int(round(min(corner.x for corner in device_corners))) - pixmap.x
+        y0 = int(round(min(corner.y for corner in device_corners))) - pixmap.y
+        return image[max(y0, 0):y0 + int(round(h * scale)), max(x0, 0):x0 + int(round(w * scale))]
+
+
+def iter_pdf(pdf, dpi=300):
+    """
+    Yield the pages of the pdf file, one page at a time (only the current page is rendered)
+    If nessesary, rotate images
+    :param pdf: PDF file (fitz Document)
+    :param dpi: Resolution of the page images
+    :return: Generator of (rotated) pages
+    """
+    for page_num in range(len(pdf)):  # Iterate over all pages
+        yield ScannedPage(pdf[page_num], dpi)
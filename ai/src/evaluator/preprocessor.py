@@ -5,13 +5,30 @@ import skimage.filters.thresholding as th
 import pythreshold.utils as putils
 import imutils.contours
 import json
-from PyPDF2 import PdfReader, PdfWriter
-from qreader import QReader
-from deskew import determine_skew
-from concurrent.futures import ThreadPoolExecutor
-
-from ai.src.evaluator.pdf_rotator import load_pdf
-from ai.src.utils import load_config, get_A4_size, get_max_num_of_rects_in_page, get_num_of_rects_per_page
+import base64
+import fitz
+import itertools
+import os
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from ai.src.evaluator.pdf_rotator import iter_pdf, ScannedPage
+from ai.src.evaluator.qr_reader import decode_qr, read_qr, count_qr_hit, warmup
+from ai.src.generator.bubble_sheet_generator import RECT_PAD, POINTS_PER_INCH, get_sheet_layout
+from ai.src.utils import load_config
+
+# Part of the bubble radius which is sampled (the outline of the bubble is left out)
+BUBBLE_SAMPLE_RADIUS = 0.7
+# Part of the sampled inside of the bubble that has to be dark to count the bubble as filled
+FILL_THRESHOLD = 0.5
+# Distance of the fill ratio from the threshold with full confidence (the bubble is clearly filled or empty)
+CONFIDENCE_MARGIN = 0.25
+# Bubbles with lower confidence should be checked by a human
+REVIEW_CONFIDENCE = 0.5
+# Closing of the dark pixels of the box
+FILL_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
 
 
 def show_images(titles, images):
@@ -126,188 +143,310 @@ def rotate_img(image, angle):
     return rotated
 
 
-def map_pages_to_students(collection, path_to_pdf):
+# Process pool for the page analysis, reused by all the requests (the QR code readers of the workers stay loaded)
+process_pool = None
+process_pool_size = 0
+# Number of the worker processes with the QR code reader loaded (shared with the workers)
+process_pool_ready = None
+process_pool_lock = threading.Lock()
+
+# Scanned PDF opened in the worker process (name of the shared memory and the document) with the configuration and
+# the layout of its test - loaded once for every request, not for every page
+worker_pdf = {"name": None, "document": None, "config": None, "layout": None}
+
+
+def get_process_pool(processes):
+    """
+    Get the process pool for the page analysis (created on the first use)
+    :param processes: Number of worker processes
+    :return: Process pool
+    """
+    global process_pool, process_pool_size, process_pool_ready
+    with process_pool_lock:
+        if process_pool is None or process_pool_size != processes:
+            if process_pool is not None:
+                process_pool.shutdown()
+            # Spawned, not forked - the server runs threads (QR code warmup, other requests), a forked worker could
+            # inherit their locks (warmup_lock, render_lock) held and wait for them forever
+            mp_context = multiprocessing.get_context("spawn")
+            process_pool_ready = mp_context.Value("i", 0)
+            process_pool = ProcessPoolExecutor(max_workers=processes, initializer=init_page_worker,
+                                               initargs=(process_pool_ready,), mp_context=mp_context)
+            process_pool_size = processes
+    return process_pool
+
+
+def init_page_worker(workers_ready):
+    """
+    Initialize the worker process of the page analysis - one QR code reader is enough for one process
+    (the worker starts with a fresh module state and loads its own reader)
+    :param workers_ready: Shared counter of the workers with the reader loaded
+    """
+    warmup(1)
+    with workers_ready.get_lock():
+        workers_ready.value += 1
+
+
+def warmup_page_workers(processes=None):
+    """
+    Start all the worker processes of the page analysis, so they load their QR code readers before the first request
+    Called at the server start, nothing is started if the pages are analysed in threads
+    :param processes: Number of worker processes, if None, the configuration file is used
+    """
+    if processes is None:
+        processes = load_config()["workers"]["evaluator_processes"]
+    if processes > 0:
+        executor = get_process_pool(processes)
+        # The pool starts a new worker for every task submitted while no worker is idle
+        for future in [executor.submit(os.getpid) for _ in range(processes)]:
+            future.result()
+
+
+def page_workers_ready(processes=None):
+    """
+    Check if all the worker processes of the page analysis have loaded their QR code readers
+    :param processes: Number of worker processes, if None, the configuration file is used
+    :return: True if the workers are ready (always true if the pages are analysed in threads)
+    """
+    if processes is None:
+        processes = load_config()["workers"]["evaluator_processes"]
+    if processes == 0:
+        return True
+    with process_pool_lock:
+        return process_pool_size == processes and process_pool_ready.value >= processes
+
+
+def analyse_shared_page(pdf_name, pdf_size, pdf_page_index, analysis_dpi, num_of_q, bubbles_dpi, decoded_text=None,
+                        thumbnails=False):
+    """
+    Render and analyse a single page of the scanned PDF in the shared memory
+    Used in the worker processes - only the PDF file is shared, the page images never leave the worker
+    :param pdf_name: Name of the shared memory with the PDF file
+    :param pdf_size: Size of the PDF file (bytes)
+    :param pdf_page_index: Global index of the page
+    :param analysis_dpi: Resolution of the page image
+    :param num_of_q: Number of questions (the layout is calculated only once for every request)
+    :param bubbles_dpi: Resolution in which the boxes with the bubbles are read
+    :param decoded_text: Already decoded QR code of the page (if None, it is decoded here)
+    :param thumbnails: If true, the thumbnails of the bubbles to be checked by a human are kept
+    :return: Page analysis without the page image (or None if the QR code was not read), the decoder which read
+             the QR code is counted by the main process (see PageAnalysis.qr_decoder)
+    """
+    # Open the PDF (and load the configuration) only once for every request
+    if worker_pdf["name"] != pdf_name:
+        if worker_pdf["document"] is not None:
+            worker_pdf["document"].close()
+        shared_pdf = shared_memory.SharedMemory(name=pdf_name)
+        try:
+            pdf_data = bytes(shared_pdf.buf[:pdf_size])
+        finally:
+            shared_pdf.close()
+        worker_pdf["name"] = pdf_name
+        worker_pdf["document"] = fitz.open(stream=pdf_data, filetype="pdf")
+        worker_pdf["config"] = load_config()
+        worker_pdf["layout"] = get_sheet_layout(worker_pdf["config"], num_of_q)
+
+    page = ScannedPage(worker_pdf["document"][pdf_page_index], analysis_dpi)
+    analysis = analyse_page(worker_pdf["config"], page, pdf_page_index, worker_pdf["layout"], bubbles_dpi,
+                            decoded_text, thumbnails)
+    if analysis is not None:
+        # Do not send the image back to the main process
+        analysis.image = None
+
+    return analysis
+
+
+def map_pages_to_students(collection, pdf_data, dpi=None, processes=None, thumbnails=False, progress=None,
+                          on_student=None):
     """
     Map the pages to students based on the student ID (and of course the test ID - QR code)
     :param collection: DB collection
-    :param path_to_pdf: Path to the PDF file (with the scanned pages (filled bubbles))
-    :return: Dictionary containing the student IDs and the corresponding pages
+    :param pdf_data: PDF file (bytes) with the scanned pages (filled bubbles)
+    :param dpi: Resolutions (analysis, bubbles) of the page images, if None, the configuration file is used
+    :param processes: Number of worker processes (0 = threads), if None, the configuration file is used
+    :param thumbnails: If true, the thumbnails of the bubbles to be checked by a human are kept
+    :param progress: Function called after every analysed page with the number of done pages, failed pages
+                     (QR code not read) and all the pages
+    :param on_student: Function called with the test ID and the page analyses of a student (sorted by the page number)
+                       as soon as all the pages of the student are analysed, the students with missing pages are passed
+                       at the end (in the order of the pages in the PDF)
+    :return: Dictionary containing the student IDs and the corresponding pages, test ID and
+             dictionary containing the PDF page indices and the page analyses (without the images, see PageAnalysis)
     """
     # Load the configuration file
     config = load_config()
-
-    pdf = load_pdf(path_to_pdf)
-
-    # A4 paper size in inches
-    A4 = get_A4_size()
+    # Number of pages processed at once (only a bounded window of pages is held in memory)
+    workers = config["workers"]["evaluator"]
+    # The pages can be analysed in processes instead of threads (OpenCV and deskew hold the GIL most of the time)
+    if processes is None:
+        processes = config["workers"]["evaluator_processes"]
+    if processes > 0:
+        workers = processes
+    # The whole page is analysed (QR code, skew, boxes) in a low resolution, only the bubbles in a high one
+    if dpi is None:
+        dpi = config["dpi"]["analysis"], config["dpi"]["bubbles"]
+    analysis_dpi, bubbles_dpi = dpi
+
+    # Pages are rendered one at a time
+    pdf_document = fitz.open(stream=pdf_data, filetype="pdf")
+    pdf = iter_pdf(pdf_document, analysis_dpi)
 
     # Find the QR code
-    qreader = QReader(model_size='s')
-    index = 0
-    first_page = pdf[index]
-    decoded_text = qreader.detect_and_decode(image=first_page, return_detections=False)
-    # If the first page has bad QR quality, try the next one
-    while (len(decoded_text) == 1 and decoded_text[0] is None) and index < len(pdf):
-        index += 1
-        next_page = pdf[index]
-        decoded_text = qreader.detect_and_decode(image=next_page, return_detections=False)
+    # Page already taken from the iterator with the decoded QR code (it still has to be processed)
+    first_page = None
+    decoded_text = None
+    # If the first page has bad QR quality, try the next one - the leading pages without the QR code are not kept,
+    # they are counted as failed right away (their analysis would not read the QR code either)
+    skipped_pages = 0
+    for page in pdf:
+        page.deskew()
+        decoded_text = decode_qr(page.image)
+        if decoded_text is not None:
+            first_page = page
+            break
+        skipped_pages += 1
 
     # If no QR code was found at all, return None (handled from the caller)
-    if len(decoded_text) == 1 and decoded_text[0] is not None:
-        qr_json = json.loads(decoded_text[0])
+    if decoded_text is not None:
+        qr_json = json.loads(decoded_text)
     else:
-        return None, None
+        pdf_document.close()
+        return None, None, None
 
     # Get the test ID from the QR code
     test_id = qr_json["test_id"]
 
-    # Calculate the number of rectangles that can fit in the figure
-    num_of_rects_per_page = get_max_num_of_rects_in_page(config, A4)
-
     # Number of questions
-    num_of_q = collection.find_one({"test_id": test_id})["num_of_questions"]
-    num_of_q_per_rect = config["answer_rect"]["grid"]["rows"]
-    num_of_rect = int(np.ceil(num_of_q / num_of_q_per_rect))
+    num_of_q = collection.find_one({"test_id": test_id}, {"_id": 0, "num_of_questions": 1})["num_of_questions"]
 
-    # Calculate the number of pages needed
-    num_of_pages = int(np.ceil(num_of_rect / num_of_rects_per_page))
-    num_of_rects_in_page = get_num_of_rects_per_page(num_of_rect, num_of_pages, num_of_rects_per_page)
+    # Layout of the pages (the same one the bubble sheets were generated with)
+    layout = get_sheet_layout(config, num_of_q)
 
-    student_page_ids = {}
+    # Every page is analysed only once, the answers are read right away (the image is not kept)
+    page_answers = {}
+    pages_failed = skipped_pages
+    # Pages of the students not passed to on_student yet and the students already passed
+    pending_students = {}
+    finished_students = set()
 
-    def process_page(page, pdf_page_index, num_of_rects_in_page, qreader):
+    def process_page(page, pdf_page_index, decoded_text=None):
         """
-        Process a single page
+        Analyse a single page
         Used for parallel processing
-        :param page: Page
+        :param page: Scanned page (see ScannedPage)
         :param pdf_page_index: Global index of the page
-        :param num_of_rects_in_page: Number of rectangles in each page
-        :param qreader: QR code reader
-        :return: Student ID, page number, and PDF page index (or None if the QR code was not read)
+        :param decoded_text: Already decoded QR code of the page (if None, it is decoded here)
+        :return: Page analysis (or None if the QR code was not read)
         """
-        skew_detect_img = page[:int(page.shape[0] * 0.5), :int(page.shape[1] * 0.5)]
-        angle = determine_skew(skew_detect_img)
-        if angle != 0:
-            page = rotate_img(page, angle)
-
-        student_id = []
-
-        decoded_text = qreader.detect_and_decode(image=page, return_detections=False)
-        if len(decoded_text) == 1 and decoded_text[0] is not None:
-            qr_json = json.loads(decoded_text[0])
-        else:
-            # Just skip the bad QR quality page, no need to return an error, it will be handled later
-            return None
-        page_num = qr_json["page"]
-
-        k = num_of_rects_in_page[page_num] + 1  # +1 for student id
-
-        # Convert the image to grayscale and threshold it
-        gray_filled = cv2.cvtColor(page, cv2.COLOR_RGB2GRAY)
-        threshed_filled = threshold_otsu(gray_filled, 170)
-
-        # Find the big boxes around the answer bubbles
-        contours = find_contours(threshed_filled)
-        # Pick k largest contours
-
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)[:k]
-        contours = imutils.contours.sort_contours(contours, method="left-to-right")[0]
-
-        student_contour = contours[0]
-        x, y, w, h = cv2.boundingRect(student_contour)
-
-        # Throw away 1% of the border of the image
-        diff = w // 100 if w > h else h // 100
-        x += diff
-        y += diff
-        w -= 2 * diff
-        h -= 2 * diff
-
-        student_subimage = page[y:y + h, x:x + w]
-
-        # Find contours of circles
-        gray = cv2.cvtColor(student_subimage, cv2.COLOR_RGB2GRAY)
-        threshed = threshold_otsu(gray, 170)
-        contours = find_contours(threshed)
-
-        # Threshold the subimage
-        threshed_subimage = cv2.GaussianBlur(student_subimage, (5, 5), 0)
-        threshed_subimage = threshold_mean(threshed_subimage)
-
-        # Find specified number of circles
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)
-        temp_contours = []
-        for contour in contours:
-            (x, y, w, h) = cv2.boundingRect(contour)
-            temp_image = threshed_subimage[y:y + h, x:x + w]
-            blurred = cv2.medianBlur(temp_image, 5)
-            gray = cv2.cvtColor(blurred, cv2.COLOR_RGB2GRAY)
-            circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, 20, param1=5, param2=10, minRadius=10)
-
-            if circles is not None:
-                temp_contours.append(contour)
-                if len(temp_contours) == 40:
-                    break
-        contours = temp_contours
-
-        # Sort them top to bottom, for easier processing
-        contours = imutils.contours.sort_contours(contours, method="top-to-bottom")[0]
-
-        while len(contours) < 40:
-            contours = list(contours)
-            contours.append(contours[-1])
-            contours = tuple(contours)
-
-        # Iterate over the circles
-        for (q, j) in enumerate(np.arange(0, len(contours), 4)):
-            # Sort the contours from left to right
-            subcontours = imutils.contours.sort_contours(contours[j:j + 4])[0]
-            # Create array for answers
-            student_id.append([])
-
-            # Iterate over the subcontours
-            for bubble in subcontours:
-                # Find the bounding box of the bubble
-                (x, y, w, h) = cv2.boundingRect(bubble)
-
-                # Find the bubble subimage and convert it to grayscale
-                bubble_subimage = threshed_subimage[y:y + h, x:x + w]
-                one_channel = cv2.cvtColor(bubble_subimage, cv2.COLOR_RGB2GRAY)
-                # Close the image using morphological operations
-                closed = cv2.morphologyEx(one_channel, cv2.MORPH_CLOSE,
-                                          cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
-
-                # Count the number of white pixels and the total number of pixels
-                pixels = cv2.countNonZero(closed)
-                num_pixels = w * h
-
-                # We found out that the circle often takes up around 40-50% of the area
-                # So if the whole area is at least 75% filled, the student probably tried to at least fill the circle
-                if pixels > 0.75 * num_pixels:
-                    student_id[q].append(1)
-                else:
-                    student_id[q].append(0)
-
-        detected_student_id = ''.join(str(column.index(1)) for column in zip(*student_id) if 1 in column)
-
-        return detected_student_id, page_num, pdf_page_index
-
-    # Use ThreadPoolExecutor to parallelize the processing
-    with ThreadPoolExecutor() as executor:
-        # Create a list of futures
-        futures = [executor.submit(process_page, page, pdf_page_index, num_of_rects_in_page, qreader)
-                   for pdf_page_index, page in enumerate(pdf)]
+        return analyse_page(config, page, pdf_page_index, layout, bubbles_dpi, decoded_text, thumbnails)
 
+    def collect(futures):
+        """
+        Collect the results of the finished pages
+        :param futures: Finished futures
+        """
+        nonlocal pages_failed
         for future in futures:
-            if future.result() is None:  # Skip from the original code (here returned None)
+            returned = True
+            try:
+                analysis = future.result()
+            except Exception as e:
+                # One unreadable page (e.g. the boxes were not found) does not stop the other pages
+                print(f'An error occurred while analysing the page: {e}')
+                analysis = None
+                returned = False
+            if analysis is None:  # Skip from the original code (here returned None)
+                if returned:
+                    # None is returned only if no decoder read the QR code
+                    count_qr_hit("failed")
+                pages_failed += 1
+                if progress is not None:
+                    progress(len(page_answers), pages_failed, len(pdf_document))
                 continue
-            page_result = future.result()
-            if page_result:
-                detected_student_id, page_num, pdf_page_index = page_result
-                if detected_student_id not in student_page_ids:
-                    student_page_ids[detected_student_id] = [{page_num: pdf_page_index}]
-                else:
-                    student_page_ids[detected_student_id].append({page_num: pdf_page_index})
+            # The hits of the decoders are counted here, the worker processes have their own statistics
+            if analysis.qr_decoder is not None:
+                count_qr_hit(analysis.qr_decoder)
+            # Only the results are kept, the page image is thrown away
+            analysis.image = None
+            page_answers[analysis.pdf_page_index] = analysis
+            if progress is not None:
+                progress(len(page_answers), pages_failed, len(pdf_document))
+            if on_student is not None:
+                add_student_page(analysis)
+
+    def add_student_page(analysis):
+        """
+        Add the page to its student, pass the student to on_student once all of its pages are analysed
+        :param analysis: Page analysis
+        """
+        if not is_student_id(analysis.student_id):
+            return
+        if analysis.student_id in finished_students:
+            print(f'Page {analysis.page_num} of student {analysis.student_id} is in the PDF more than once, skipped')
+            return
+        pages = pending_students.setdefault(analysis.student_id, [])
+        pages.append(analysis)
+        if len({page.page_num for page in pages}) == layout.num_of_pages:
+            finished_students.add(analysis.student_id)
+            del pending_students[analysis.student_id]
+            on_student(test_id, sorted(pages, key=lambda page: (page.page_num, page.pdf_page_index)))
+
+    def submit_all(tasks):
+        """
+        Submit the pages for the analysis and collect the results
+        :param tasks: Generator of the tasks (thread or process pool, function and its arguments), one task for each page
+        """
+        futures = set()
+        for executor, *task in tasks:
+            # Keep only a bounded window of pages in flight, so the peak memory does not grow with the number of pages
+            if len(futures) >= 2 * workers:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            else:
+                # Every page is collected as soon as it is finished (progress), not only when the window is full
+                done = {future for future in futures if future.done()}
+                futures -= done
+            collect(done)
+            futures.add(executor.submit(*task))
+
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    if processes > 0:
+        # Pages are rendered and analysed in the worker processes, only the PDF file is shared with them
+        # The page with the QR code is already rendered and deskewed here, it is analysed in this process meanwhile
+        executor = get_process_pool(processes)
+        shared_pdf = shared_memory.SharedMemory(create=True, size=len(pdf_data))
+        try:
+            shared_pdf.buf[:len(pdf_data)] = pdf_data
+            with ThreadPoolExecutor(max_workers=1) as first_page_executor:
+                submit_all(itertools.chain(
+                    [(first_page_executor, process_page, first_page, skipped_pages, decoded_text)],
+                    ((executor, analyse_shared_page, shared_pdf.name, len(pdf_data), pdf_page_index, analysis_dpi,
+                      num_of_q, bubbles_dpi, None, thumbnails)
+                     for pdf_page_index in range(skipped_pages + 1, len(pdf_document)))))
+        finally:
+            shared_pdf.close()
+            shared_pdf.unlink()
+    else:
+        # Use ThreadPoolExecutor to parallelize the processing
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = itertools.chain([(first_page, decoded_text)], ((page, None) for page in pdf))
+            submit_all((executor, process_page, page, pdf_page_index, decoded_text)
+                       for pdf_page_index, (page, decoded_text) in enumerate(pages, start=skipped_pages))
+
+    pdf_document.close()
+
+    # Students with missing pages (or with unreadable pages) are evaluated with the pages they have
+    if on_student is not None:
+        for pages in sorted(pending_students.values(), key=lambda pages: min(page.pdf_page_index for page in pages)):
+            on_student(test_id, sorted(pages, key=lambda page: (page.page_num, page.pdf_page_index)))
+
+    # Students in the order of the pages in the PDF (the pages are finished in any order)
+    student_page_ids = {}
+    for pdf_page_index in sorted(page_answers):
+        analysis = page_answers[pdf_page_index]
+        student_page_ids.setdefault(analysis.student_id, []).append({analysis.page_num: pdf_page_index})
 
     # Sort the pages by the page_num key
     result_student_page_ids = {}
@@ -318,256 +457,337 @@ def map_pages_to_students(collection, path_to_pdf):
     for student_id, pages in result_student_page_ids.items():
         result_student_page_ids[student_id] = [list(page.values())[0] for page in pages]
 
-    return result_student_page_ids, test_id
+    return result_student_page_ids, test_id, page_answers
 
 
-def create_temp_pdfs(student_page_ids, path_to_pdf):
+def is_student_id(student_id):
+    """
+    Check if the detected student ID is an integer (otherwise the detection failed)
+    :param student_id: Detected student ID
+    :return: True if the student ID is an integer
     """
-    Create temporary PDFs for each student
+    try:
+        _ = int(student_id)
+    except ValueError:
+        return False
+    return True
+
+
+def group_pages_by_student(student_page_ids, page_answers):
+    """
+    Group the (already evaluated) pages by student
     :param student_page_ids: Dictionary containing the student IDs and the corresponding pages
-    :param path_to_pdf: Path to the PDF file
-    :return: List of temporary PDF names
+    :param page_answers: Dictionary containing the PDF page indices and the page analyses
+    :return: List of page analysis lists (one list for each student)
     """
-    pdf_names = []
+    student_pages = []
+
+    # Group by student ID over pages
+    for student_id, page_ids in student_page_ids.items():
+        if not is_student_id(student_id):
+            continue
+
+        student_pages.append([page_answers[page_id] for page_id in page_ids])
+
+    return student_pages
 
-    # Create sub pdfs for each student (group by student ID over pages)
-    reader = PdfReader(path_to_pdf)
 
-    # Function to create PDF for a single student
-    def create_student_pdf(student_id, page_ids):
+class PageAnalysis:
+    """
+    Result of the analysis of one scanned page
+    """
+    def __init__(self, pdf_page_index, angle, image, qr, boxes, student_id, answers, fill_ratios, thumbnails,
+                 qr_decoder=None):
         """
-        Create a PDF for a single student
-        :param student_id: Student ID
-        :param page_ids: List of page IDs
-        :return: Path to the temporary PDF
+        Initialize the page analysis
+        :param pdf_page_index: Global index of the page in the scanned PDF
+        :param angle: Skew angle of the page (in degrees)
+        :param image: Page image (rotated and deskewed)
+        :param qr: Decoded QR code (test ID and page number)
+        :param boxes: Corners of the boxes from left to right (student ID grid first, see find_boxes)
+        :param student_id: Detected student ID
+        :param answers: Filled bubbles of every box of the page (on the first page the student ID grid goes first)
+        :param fill_ratios: Fill ratios of the bubbles of every box of the page (student ID grid always first)
+        :param thumbnails: Thumbnails (PNG, base64) of the bubbles to be checked by a human, dictionary
+                           {(row, col): thumbnail} for every box of the page (student ID grid always first)
+        :param qr_decoder: Decoder which read the QR code (see qr_stats), None if it was decoded before the analysis
         """
-        try:
-            # Check if the student ID is an integer
-            _ = int(student_id)
-        except ValueError:
-            return None
-
-        writer = PdfWriter()
-        for page_id in page_ids:
-            writer.add_page(reader.pages[page_id])
-
-        pdf_name = f"temp_{student_id}.pdf"
-        with open(pdf_name, 'wb') as output_pdf:
-            writer.write(output_pdf)
-        return pdf_name
-
-    # Use ThreadPoolExecutor to parallelize PDF creation
-    with ThreadPoolExecutor() as executor:
-        # Map the create_student_pdf function to each student
-        futures = [executor.submit(create_student_pdf, student_id, page_ids)
-                   for student_id, page_ids in student_page_ids.items()]
-
-        # Collect the results as they are completed
-        for future in futures:
-            pdf_name = future.result()
-            if pdf_name:
-                pdf_names.append(pdf_name)
-
-    return pdf_names
+        self.pdf_page_index = pdf_page_index
+        self.angle = angle
+        self.image = image
+        self.qr = qr
+        self.boxes = boxes
+        self.student_id = student_id
+        self.answers = answers
+        self.fill_ratios = fill_ratios
+        self.thumbnails = thumbnails
+        self.qr_decoder = qr_decoder
+
+    @property
+    def page_num(self):
+        """
+        Page number of the bubble sheet (from the QR code)
+        :return: Page number
+        """
+        return self.qr["page"]
 
 
-def preprocess_image(collection, path_to_image, test_id):
+def analyse_page(config, page, pdf_page_index, layout, bubbles_dpi=300, decoded_text=None, thumbnails=False):
     """
-    Preprocess the image and detect filled bubbles
-    :param collection: DB collection
-    :param path_to_image: Path to the image
-    :return: JSON output with student ID and answers
+    Analyse the page - deskew it, decode the QR code, find the boxes and read the student ID and the answers
+    Every step runs only once per page
+    :param config: Configuration dictionary
+    :param page: Scanned page (see ScannedPage)
+    :param pdf_page_index: Global index of the page in the scanned PDF
+    :param layout: Layout of the bubble sheet (see SheetLayout)
+    :param bubbles_dpi: Resolution in which the boxes with the bubbles are read
+    :param decoded_text: Already decoded QR code of the page (if None, it is decoded here)
+    :param thumbnails: If true, the thumbnails of the bubbles to be checked by a human are kept
+    :return: Page analysis (or None if the QR code was not read)
     """
-    # Load the configuration file
-    config = load_config()
+    angle = page.deskew()
 
-    num_rows = config["answer_rect"]["grid"]["rows"]
-    num_cols = config["answer_rect"]["grid"]["cols"]
+    # The decoder is not counted here, the page can be analysed in a worker process (see PageAnalysis.qr_decoder)
+    qr_decoder = None
+    if decoded_text is None:
+        decoded_text, qr_decoder = read_qr(page.image)
+    if decoded_text is None:
+        # Just skip the bad QR quality page, no need to return an error, it will be handled later
+        return None
+    qr_json = json.loads(decoded_text)
+    page_num = qr_json["page"]
 
-    scanned_filled_images = load_pdf(path_to_image)
+    layout_boxes = layout.boxes[page_num]  # Student ID box included
+    boxes = find_boxes(page.image, len(layout_boxes))
+    box_answers, fill_ratios, box_thumbnails = read_page_answers(config, page, boxes, layout_boxes, bubbles_dpi,
+                                                                 thumbnails)
 
-    # A4 paper size in inches
-    A4 = get_A4_size()
+    student_id = decode_student_id(box_answers[0])
+    # The student ID grid is a part of the answers only on the first page
+    answers = box_answers if page_num == 0 else box_answers[1:]
 
-    # Calculate the number of rectangles that can fit in the figure
-    num_of_rects_per_page = get_max_num_of_rects_in_page(config, A4)
+    return PageAnalysis(pdf_page_index, angle, page.image, qr_json, boxes, student_id, answers, fill_ratios,
+                        box_thumbnails, qr_decoder)
 
-    # Number of questions
-    num_of_q = collection.find_one({"test_id": test_id})["num_of_questions"]
-    num_of_q_per_rect = config["answer_rect"]["grid"]["rows"]
-    num_of_rect = int(np.ceil(num_of_q / num_of_q_per_rect))
-    last_rect_q = num_of_q % num_of_q_per_rect
 
-    # Calculate the number of pages needed
-    num_of_pages = len(scanned_filled_images)
+def find_boxes(image, k):
+    """
+    Find the big (rounded) boxes around the bubbles
+    :param image: Page image (rotated and deskewed)
+    :param k: Number of boxes (student ID grid included)
+    :return: Corners of the boxes from left to right - intersections of the (outer) sides of the boxes
+             (top left, top right, bottom right, bottom left)
+    :raise ValueError: If a box was not found (its side cannot be fitted)
+    """
+    # Convert the image to grayscale and threshold it
+    gray_filled = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    threshed_filled = threshold_otsu(gray_filled, 170)
+
+    # Find the big boxes around the answer bubbles (all the points are kept, the sides are fitted with lines)
+    contours, _ = cv2.findContours(threshed_filled, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    # Pick k largest contours
+    contours = sorted(contours, key=cv2.contourArea, reverse=True)[:k]
+    contours = imutils.contours.sort_contours(contours, method="left-to-right")[0]
+
+    boxes = []
+    for contour in contours:
+        points = contour.reshape(-1, 2).astype(np.float32)
+        x, y, w, h = cv2.boundingRect(contour)
+
+        # Points of the straight parts of the sides (the rounded corners are left out)
+        middle_x = (points[:, 0] > x + 0.1 * w) & (points[:, 0] < x + 0.9 * w)
+        middle_y = (points[:, 1] > y + 0.1 * h) & (points[:, 1] < y + 0.9 * h)
+        sides = [points[middle_x & (points[:, 1] < y + 0.1 * h)],  # Top
+                 points[middle_y & (points[:, 0] > x + 0.9 * w)],  # Right
+                 points[middle_x & (points[:, 1] > y + 0.9 * h)],  # Bottom
+                 points[middle_y & (points[:, 0] < x + 0.1 * w)]]  # Left
+        if any(len(side) < 2 for side in sides):
+            raise ValueError("Box not found on the page (a side of the box has no points)")
+        lines = [cv2.fitLine(side, cv2.DIST_HUBER, 0, 0.01, 0.01).ravel() for side in sides]
+
+        # Corners are the intersections of the neighbouring sides
+        boxes.append(np.array([intersect_lines(lines[3], lines[0]), intersect_lines(lines[0], lines[1]),
+                               intersect_lines(lines[1], lines[2]), intersect_lines(lines[2], lines[3])],
+                              dtype=np.float32))
+
+    return boxes
+
+
+def intersect_lines(line1, line2):
+    """
+    Find the intersection of two lines
+    :param line1: Line (vx, vy, x0, y0) - direction and a point (see cv2.fitLine)
+    :param line2: Line (vx, vy, x0, y0)
+    :return: Intersection (x, y)
+    """
+    vx1, vy1, x1, y1 = line1
+    vx2, vy2, x2, y2 = line2
+    # x1 + t * vx1 = x2 + u * vx2, y1 + t * vy1 = y2 + u * vy2
+    t = np.linalg.solve([[vx1, -vx2], [vy1, -vy2]], [x2 - x1, y2 - y1])[0]
+    return x1 + t * vx1, y1 + t * vy1
+
+
+def decode_student_id(id_bubbles):
+    """
+    Decode the student ID from the filled bubbles of the student ID grid
+    :param id_bubbles: Filled bubbles of the student ID grid (rows of digits, columns of positions)
+    :return: Student ID (string)
+    """
+    return ''.join(str(column.index(1)) for column in zip(*id_bubbles) if 1 in column)
 
-    # Calculate the number of rectangles in each page
-    num_of_rects_in_page = get_num_of_rects_per_page(num_of_rect, num_of_pages, num_of_rects_per_page)
-    num_of_rects_in_page_copy = num_of_rects_in_page.copy()
 
-    # Create subimages from the big boxes
-    subimages = []
+def read_page_answers(config, scanned_filled, boxes, layout_boxes, bubbles_dpi=300, thumbnails=False):
+    """
+    Detect filled bubbles in the boxes of one (deskewed) page
+    :param config: Configuration dictionary
+    :param scanned_filled: Scanned page (rotated and deskewed, see ScannedPage)
+    :param boxes: Corners of the boxes (see find_boxes)
+    :param layout_boxes: Layouts of the boxes of the page (see SheetLayout.boxes)
+    :param bubbles_dpi: Resolution in which the boxes with the bubbles are read
+    :param thumbnails: If true, the thumbnails of the bubbles to be checked by a human are made
+    :return: Filled bubbles (1 = filled), fill ratios (see score_box) and thumbnails (see make_thumbnails)
+             of every box of the page (the student ID grid goes first)
+    """
     answers = []
-    how_many_circles = []
-
-    for indx, scanned_filled in enumerate(scanned_filled_images):
-        # Number of circles in each subimage
-        # Rows * Cols
-        student_id_grid = config["student_id_rect"]["grid"]["rows"] * config["student_id_rect"]["grid"]["cols"]
-
-        if indx == 0:
-            answer_grid = [student_id_grid]
-        else:
-            answer_grid = []
-
-        # Pick k largest contours
-        k = num_of_rects_in_page_copy.pop(0) + 1  # +1 for student id
-
-        max_grid = num_rows * num_cols
-        answer_grid += [max_grid] * (k - 2)  # Previous bubble grids are always full
-
-        if num_of_pages == indx + 1 and last_rect_q != 0:  # Last page
-            answer_grid.append(last_rect_q * num_cols)
-        else:
-            answer_grid.append(num_rows * num_cols)
-
-        how_many_circles += answer_grid
-
-    num_of_rects_in_page_copy = num_of_rects_in_page.copy()
-    first_k = 0
-    for indx, scanned_filled in enumerate(scanned_filled_images):
-        subimages.append([])
-
-        skew_detect_img = scanned_filled[:int(scanned_filled.shape[0] * 0.5), :int(scanned_filled.shape[1] * 0.5)]
-        angle = determine_skew(skew_detect_img)
-        if angle != 0:
-            scanned_filled = rotate_img(scanned_filled, angle)
-
-        # Convert the image to grayscale and threshold it
-        gray_filled = cv2.cvtColor(scanned_filled, cv2.COLOR_RGB2GRAY)
-        threshed_filled = threshold_otsu(gray_filled, 170)
-
-        # Find the big boxes around the answer bubbles
-        contours = find_contours(threshed_filled)
-        # Pick k largest contours
-        k = num_of_rects_in_page_copy.pop(0) + 1  # +1 for student id
-        if indx == 0:
-            first_k = k
-
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)[:k]
-        contours = imutils.contours.sort_contours(contours, method="left-to-right")[0]
-
-        # Iterate over the big boxes
-        for i, contour in enumerate(contours):
-            x, y, w, h = cv2.boundingRect(contour)
-
-            # Throw away 1% of the border of the image
-            diff = w // 100 if w > h else h // 100
-            x += diff
-            y += diff
-            w -= 2 * diff
-            h -= 2 * diff
-
-            # Modify height based on the number of questions
-            if indx == 0 and i == 0:  # Student ID grid
-                pass
-            else:
-                max_circles = num_rows * num_cols
-                actual_circles = how_many_circles[indx * (first_k - 1) + i]
-                h = int(h * actual_circles / max_circles)
-
-            subimage = scanned_filled[y:y + h, x:x + w]
-            subimages[-1].append(subimage)
-
-    # For each big box
-    for page in range(num_of_pages):
-        for s in range(len(subimages[page])):
-            subimage = subimages[page][s]
-            i = page * num_of_rects_per_page + s
-            # Skip the student ID grid for every page except the first one
-            if page != 0 and s == 0:
-                continue
-            # Create array for answers
-            answers.append([])
-
-            # Find contours of circles
-            gray = cv2.cvtColor(subimage, cv2.COLOR_RGB2GRAY)
-            threshed = threshold_otsu(gray, 170)
-            contours = find_contours(threshed)
-
-            # Threshold the subimage
-            threshed_subimage = cv2.GaussianBlur(subimage, (5, 5), 0)
-            threshed_subimage = threshold_mean(threshed_subimage)
-
-            # Find specified number of circles
-            contours = sorted(contours, key=cv2.contourArea, reverse=True)
-            temp_contours = []
-            for contour in contours:
-                (x, y, w, h) = cv2.boundingRect(contour)
-                temp_image = threshed_subimage[y:y + h, x:x + w]
-                blurred = cv2.medianBlur(temp_image, 5)
-                gray = cv2.cvtColor(blurred, cv2.COLOR_RGB2GRAY)
-                circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, 20, param1=5, param2=10, minRadius=10)
-
-                if circles is not None:
-                    temp_contours.append(contour)
-                    if len(temp_contours) == how_many_circles[i]:
-                        break
-            contours = temp_contours
-            # Sort them top to bottom, for easier processing
-            contours = imutils.contours.sort_contours(contours, method="top-to-bottom")[0]
-
-            while len(contours) < how_many_circles[i]:
-                contours = list(contours)
-                contours.append(contours[-1])
-                contours = tuple(contours)
-
-            # Just for showcase purposes
-            circle_image = cv2.drawContours(subimage.copy(), contours, -1, (0, 255, 0), 2)
-
-            if i != 0:
-                num_col = num_cols  # it is an answer grid
-            else:
-                num_col = config["student_id_rect"]["grid"]["cols"]  # it is a student id grid
-
-            # Iterate over the circles
-            for (q, j) in enumerate(np.arange(0, len(contours), num_col)):
-                # Sort the contours from left to right
-                subcontours = imutils.contours.sort_contours(contours[j:j + num_col])[0]
-                # Create array for answers
-                answers[i].append([])
-
-                # Iterate over the subcontours
-                for bubble in subcontours:
-                    # Find the bounding box of the bubble
-                    (x, y, w, h) = cv2.boundingRect(bubble)
-
-                    # Just for showcase purposes
-                    cv2.rectangle(circle_image, (x, y), (x + w, y + h), (255, 0, 0), 2)
-
-                    # Find the bubble subimage and convert it to grayscale
-                    bubble_subimage = threshed_subimage[y:y + h, x:x + w]
-                    one_channel = cv2.cvtColor(bubble_subimage, cv2.COLOR_RGB2GRAY)
-                    # Close the image using morphological operations
-                    closed = cv2.morphologyEx(one_channel, cv2.MORPH_CLOSE,
-                                              cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
-
-                    # Count the number of white pixels and the total number of pixels
-                    pixels = cv2.countNonZero(closed)
-                    num_pixels = w * h
-
-                    # We found out that the circle often takes up around 40-50% of the area
-                    # So if the whole area is at least 75% filled, the student probably tried to at least fill the circle
-                    if pixels > 0.75 * num_pixels:
-                        answers[i][q].append(1)
-                    else:
-                        answers[i][q].append(0)
-
-            # Show the images (just for showcase purposes)
-            # show_images([f'subimage{i + 1}', f'threshed_subimage{i + 1}', f'circle_image{i + 1}'],
-            #             [subimage, threshed_subimage, circle_image])
-
-    output = {"student_id": ''.join(str(column.index(1)) for column in zip(*answers[0]) if 1 in column),
-              "answers": [item for sublist in answers[1:] for item in sublist]}
+    fill_ratios = []
+    box_thumbnails = []
+
+    # Iterate over the big boxes
+    for corners, box in zip(boxes, layout_boxes):
+
+        # Render the box (with a small margin) again in the resolution for the bubbles
+        x, y, w, h = cv2.boundingRect(corners)
+        margin = max(w, h) // 50
+        x, y = max(x - margin, 0), max(y - margin, 0)
+        subimage = scanned_filled.crop(x, y, w + 2 * margin, h + 2 * margin, bubbles_dpi)
+        scale = max(bubbles_dpi / scanned_filled.dpi, 1)
+        box_corners = (corners - np.array([x, y], dtype=np.float32)) * scale
+
+        grid, cell_size = rectify_box(config, box, subimage, box_corners, max(bubbles_dpi, scanned_filled.dpi))
+        # Last box of the last page can have fewer questions (the first rows are used)
+        ratios = score_box(grid, cell_size, box.cols, box.num_rows)
+        fill_ratios.append(ratios)
+        # Filled if the most of the inside of the bubble is dark
+        answers.append((ratios > FILL_THRESHOLD).astype(int).tolist())
+        box_thumbnails.append(make_thumbnails(grid, cell_size, ratios) if thumbnails else {})
+
+    return answers, fill_ratios, box_thumbnails
+
+
+def rectify_box(config, box, subimage, corners, dpi):
+    """
+    Transform the box to the layout of the bubble sheet - the grid of the bubbles becomes an image where every
+    grid cell has the same size (see draw_bubbles)
+    :param config: Configuration dictionary
+    :param box: Layout of the box (see BoxLayout)
+    :param subimage: Image of the box
+    :param corners: Corners of the box in the subimage (see find_boxes)
+    :param dpi: Resolution of the subimage
+    :return: Grayscale image of the grid and the size (width, height) of one grid cell in pixels
+    """
+    width, height = box.width, box.height
+    cols, rows = box.cols, box.rows
+
+    # Pixels per unit of the layout (data coordinates of the bubble sheet)
+    scale = (corners[1][0] - corners[0][0] + corners[2][0] - corners[3][0]) / 2 / (width + 2 * RECT_PAD)
+    # The outer edge of the box line is padded around the grid
+    offset = RECT_PAD + config["rect_settings"]["rect_line_width"] / 2 * dpi / POINTS_PER_INCH / scale
+
+    # Size of one grid cell (pixels)
+    cell_width = int(round(width / cols * scale))
+    cell_height = int(round(height / rows * scale))
+    scale_x = cell_width * cols / width
+    scale_y = cell_height * rows / height
+
+    # Known positions of the corners in the grid (top left corner of the grid is the origin)
+    layout_corners = np.array([[-offset * scale_x, -offset * scale_y],
+                               [(width + offset) * scale_x, -offset * scale_y],
+                               [(width + offset) * scale_x, (height + offset) * scale_y],
+                               [-offset * scale_x, (height + offset) * scale_y]], dtype=np.float32)
+    transform = cv2.getPerspectiveTransform(corners.astype(np.float32), layout_corners)
+
+    gray = cv2.cvtColor(subimage, cv2.COLOR_RGB2GRAY)
+    grid = cv2.warpPerspective(gray, transform, (cell_width * cols, cell_height * rows), flags=cv2.INTER_LINEAR,
+                               borderValue=255)
+
+    return grid, (cell_width, cell_height)
+
+
+def score_box(grid, cell_size, cols, num_rows):
+    """
+    Measure how much every bubble of one box is filled - every bubble is sampled at its known position
+    :param grid: Grayscale image of the grid (see rectify_box)
+    :param cell_size: Size (width, height) of one grid cell in pixels
+    :param cols: Number of bubbles in one row
+    :param num_rows: Number of rows of the bubbles to read
+    :return: Fill ratios of the bubbles (rows x cols, 0 = empty, 1 = completely filled)
+    """
+    cell_width, cell_height = cell_size
+
+    # Ink is darker than the middle between the paper and the darkest lines (gray stripes are not ink)
+    paper, ink = np.percentile(grid, [95, 2])
+    dark = (grid < (paper + ink) / 2).astype(np.uint8)
+    # Close the gaps of hatched or lightly filled bubbles (once for the whole box)
+    dark = cv2.morphologyEx(dark, cv2.MORPH_CLOSE, FILL_KERNEL)
+
+    # Only the inside of the bubble is sampled (without its outline)
+    bubble_radius = cell_width / 3 * BUBBLE_SAMPLE_RADIUS
+    yy, xx = np.mgrid[:cell_height, :cell_width]
+    mask = (xx - (cell_width - 1) / 2) ** 2 + (yy - (cell_height - 1) / 2) ** 2 <= bubble_radius ** 2
+
+    # Rows x cell rows x cols x cell cols -> dark pixels inside every bubble at once
+    cells = dark[:num_rows * cell_height].reshape(num_rows, cell_height, cols, cell_width)
+    dark_pixels = np.einsum("ihjw,hw->ij", cells, mask.astype(np.uint8), dtype=np.int64)
+
+    return dark_pixels / mask.sum()
+
+
+def bubble_confidence(fill_ratios):
+    """
+    Confidence that the bubbles were read correctly - how far their fill ratios are from the threshold
+    :param fill_ratios: Fill ratios of the bubbles (see score_box)
+    :return: Confidence of every bubble (0 = on the threshold, 1 = clearly filled or empty)
+    """
+    return np.clip(np.abs(np.asarray(fill_ratios) - FILL_THRESHOLD) / CONFIDENCE_MARGIN, 0, 1)
+
+
+def make_thumbnails(grid, cell_size, fill_ratios):
+    """
+    Make small images of the bubbles that should be checked by a human
+    :param grid: Grayscale image of the grid (see rectify_box)
+    :param cell_size: Size (width, height) of one grid cell in pixels
+    :param fill_ratios: Fill ratios of the bubbles (see score_box)
+    :return: Dictionary {(row, col): thumbnail (PNG, base64)} of the low confidence bubbles
+    """
+    cell_width, cell_height = cell_size
+    thumbnails = {}
+    for row, col in zip(*np.nonzero(bubble_confidence(fill_ratios) < REVIEW_CONFIDENCE)):
+        cell = grid[row * cell_height:(row + 1) * cell_height, col * cell_width:(col + 1) * cell_width]
+        thumbnails[(int(row), int(col))] = base64.b64encode(cv2.imencode(".png", cell)[1]).decode("ascii")
+    return thumbnails
+
+
+def merge_page_answers(pages):
+    """
+    Merge the detected bubbles of all pages of one student
+    :param pages: Page analyses of the student (in page order, see PageAnalysis)
+    :return: JSON output with student ID, answers, fill ratios of the answers and thumbnails of the low confidence
+             bubbles ({question index: {answer index: thumbnail}})
+    """
+    answers = [box for page in pages for box in page.answers]
+
+    fill_ratios = []
+    thumbnails = {}
+    for page in pages:
+        # Student ID grid is not a part of the answers
+        for ratios, box_thumbnails in zip(page.fill_ratios[1:], page.thumbnails[1:]):
+            for (row, col), thumbnail in box_thumbnails.items():
+                thumbnails.setdefault(len(fill_ratios) + row, {})[col] = thumbnail
+            fill_ratios.extend(np.round(ratios, 2).tolist())
+
+    output = {"student_id": decode_student_id(answers[0]),
+              "answers": [item for sublist in answers[1:] for item in sublist],
+              "fill_ratios": fill_ratios,
+              "thumbnails": thumbnails}
 
     return output
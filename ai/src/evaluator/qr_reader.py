@@ -0,0 +1,160 @@
+import queue
+import threading
+import numpy as np
+import cv2
+from contextlib import contextmanager
+from qreader import QReader
+from pyzbar.pyzbar import decode as zbar_decode
+
+from ai.src.utils import load_config
+
+# Loaded QR code readers (one for every evaluation thread, shared by all requests of the process)
+qreaders = queue.Queue()
+# Set once all the readers are loaded
+ready = threading.Event()
+warmup_lock = threading.Lock()
+
+# Part of the (rotated and deskewed) page with the QR code - top right corner (see QR_INSET in bubble_sheet_generator)
+QR_CORNER_HEIGHT = 0.3
+QR_CORNER_WIDTH = 0.2
+
+# How many times each decoder read the QR code (and how many times all of them failed)
+# Counted in the main process, also for the pages analysed in the worker processes (see PageAnalysis.qr_decoder)
+qr_stats = {"opencv": 0, "zbar": 0, "qreader": 0, "failed": 0}
+qr_stats_lock = threading.Lock()
+# OpenCV detectors are not shared between threads
+local = threading.local()
+
+
+def warmup(num_of_readers=None):
+    """
+    Load the QR code readers (the model is loaded only once per reader, not for every request)
+    Called at the server start, otherwise lazily by the first evaluation
+    :param num_of_readers: Number of readers, if None, the number of evaluation workers is used (only one reader
+                           if the pages are analysed in the worker processes - they have their own readers)
+    """
+    with warmup_lock:
+        if ready.is_set():
+            return
+
+        if num_of_readers is None:
+            config = load_config()
+            num_of_readers = 1 if config["workers"]["evaluator_processes"] > 0 else config["workers"]["evaluator"]
+
+        for _ in range(num_of_readers):
+            qreader = QReader(model_size='s')
+            # The first detection initializes the model, do not leave it for the first page
+            qreader.detect_and_decode(image=np.full((64, 64, 3), 255, dtype=np.uint8), return_detections=False)
+            qreaders.put(qreader)
+
+        ready.set()
+
+
+def is_ready():
+    """
+    Check if the QR code readers are loaded
+    :return: True if the readers are loaded
+    """
+    return ready.is_set()
+
+
+@contextmanager
+def borrow_qreader():
+    """
+    Borrow a QR code reader, no other thread uses it until it is returned
+    :return: QR code reader (QReader)
+    """
+    if not ready.is_set():
+        warmup()
+
+    qreader = qreaders.get()
+    try:
+        yield qreader
+    finally:
+        qreaders.put(qreader)
+
+
+def count_qr_hit(decoder):
+    """
+    Count the QR code decoded by the decoder
+    :param decoder: Name of the decoder (key of qr_stats)
+    """
+    with qr_stats_lock:
+        qr_stats[decoder] += 1
+
+
+def get_qr_stats():
+    """
+    Get the hit rates of the QR code decoders
+    :return: Dictionary with the number of hits and the hit rate of every decoder
+    """
+    with qr_stats_lock:
+        stats = dict(qr_stats)
+    total = sum(stats.values())
+
+    return {"total": total,
+            "hits": stats,
+            "rates": {decoder: hits / total if total else 0 for decoder, hits in stats.items()}}
+
+
+def decode_qr_opencv(image):
+    """
+    Decode the QR code with the OpenCV detector
+    :param image: Image (RGB)
+    :return: Decoded text or None
+    """
+    if not hasattr(local, "detector"):
+        local.detector = cv2.QRCodeDetector()
+    text, _, _ = local.detector.detectAndDecode(image)
+    return text or None
+
+
+def decode_qr_zbar(image):
+    """
+    Decode the QR code with zbar
+    :param image: Image (RGB)
+    :return: Decoded text or None
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    for symbol in zbar_decode(gray):
+        if symbol.type == "QRCODE":
+            return symbol.data.decode("utf-8")
+    return None
+
+
+def read_qr(image):
+    """
+    Decode the QR code of the page without counting the hit
+    The cheap decoders try the corner with the QR code first, the QReader model is used only if they fail
+    :param image: Page image (rotated and deskewed)
+    :return: Decoded text (or None) and the name of the decoder which read it ("failed" if none did, see qr_stats)
+    """
+    height, width = image.shape[:2]
+    corner = np.ascontiguousarray(image[:int(height * QR_CORNER_HEIGHT), int(width * (1 - QR_CORNER_WIDTH)):])
+
+    for decoder, decode in (("opencv", decode_qr_opencv), ("zbar", decode_qr_zbar)):
+        try:
+            text = decode(corner)
+        except Exception:
+            text = None
+        if text is not None:
+            return text, decoder
+
+    # Slow path - the neural detector on the whole page
+    with borrow_qreader() as qreader:
+        decoded_text = qreader.detect_and_decode(image=image, return_detections=False)
+    if len(decoded_text) == 1 and decoded_text[0] is not None:
+        return decoded_text[0], "qreader"
+
+    return None, "failed"
+
+
+def decode_qr(image):
+    """
+    Decode the QR code of the page and count the hit of the decoder
+    :param image: Page image (rotated and deskewed)
+    :return: Decoded text or None
+    """
+    text, decoder = read_qr(image)
+    count_qr_hit(decoder)
+    return text
@@ -1,19 +1,47 @@
 import os
+import io
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.colors import to_rgb
+from matplotlib.transforms import Bbox
 import fitz
 import qrcode
 import json
+import hashlib
+import threading
+import functools
 
 from ai.src.utils import load_config, get_A4_size, get_max_num_of_rects_in_page, get_num_of_rects_per_page
 
 
 # Use Agg backend for matplotlib
 matplotlib.use("Agg")
-# Question number (global across all rectangles and sheets)
-question_number = 1
+# Points per inch (PDF user space unit)
+POINTS_PER_INCH = 72
+# Position of the QR code inset in the page axes (x, y, width, height in axes coordinates)
+QR_INSET = [0.87, 0.85, 0.2, 0.2]
+# Number of the latest QR code images kept (one per test and page, see get_qr_image)
+QR_CACHE_SIZE = 256
+# Padding (and corner radius) of the rounded rectangles around the bubbles (data coordinates)
+RECT_PAD = 0.01
+
+# Layouts of the bubble sheets, key is (hash of the configuration, number of questions), see get_sheet_layout
+sheet_layouts = {}
+sheet_layouts_lock = threading.Lock()
+
+
+def get_header_font_size_relative(config, figure_height):
+    """
+    Get the header font size relative to the figure height (in data coordinates)
+    :param config: Configuration dictionary
+    :param figure_height: Height of the figure in inches
+    :return: Relative font size
+    """
+    PIXELS_PER_INCH = 96
+
+    return config["header"]["font_size"] / (figure_height * PIXELS_PER_INCH)
 
 
 def draw_header(ax, config, rect_x, rect_y, date, student_name):
@@ -24,16 +52,13 @@ def draw_header(ax, config, rect_x, rect_y, date, student_name):
     :param rect_x: The x-coordinate of the rectangle top left corner
     :param rect_y: The y-coordinate of the rectangle top left corner
     :param date: Date of the test
-    :param student_name: Student name
+    :param student_name: Student name (None to leave the name line out, e.g. for a template)
     """
-    PIXELS_PER_INCH = 96
-
     # Configuration
     header_title = config["header"]["title"]
     header_date = config["header"]["date"] + date
-    header_name = config["header"]["name"] + student_name
     font_size = config["header"]["font_size"]
-    font_size_relative = font_size / (ax.figure.get_figheight() * PIXELS_PER_INCH)
+    font_size_relative = get_header_font_size_relative(config, ax.figure.get_figheight())
     font = config["header"]["font"]
     text_color = config["colors"]["main_color"]
 
@@ -42,9 +67,11 @@ def draw_header(ax, config, rect_x, rect_y, date, student_name):
     rect_x -= font_size_relative
     ax.text(rect_x, rect_y, header_title, ha='left', va='bottom', fontsize=font_size + 5, fontname=font,
             color=text_color, weight='bold')
-    font_size_offset = font_size_relative * 2
-    ax.text(rect_x, rect_y - font_size_offset, header_name, ha='left', va='bottom', fontsize=font_size, fontname=font,
-            color=text_color)
+    if student_name is not None:
+        header_name = config["header"]["name"] + student_name
+        font_size_offset = font_size_relative * 2
+        ax.text(rect_x, rect_y - font_size_offset, header_name, ha='left', va='bottom', fontsize=font_size,
+                fontname=font, color=text_color)
     font_size_offset = font_size_relative * 4
     ax.text(rect_x, rect_y - font_size_offset, header_date, ha='left', va='bottom', fontsize=font_size, fontname=font,
             color=text_color)
@@ -93,15 +120,12 @@ def gray_out(ax, config, rect_x, rect_y, rect_type="answer_rect", gray_columns=F
                 ax.add_patch(rect)
 
 
-def draw_bubbles(ax, config, rect_x, rect_y, rect_type, last_rect_q, student_id):
+def draw_bubbles(ax, config, box, student_id):
     """
     Draw the bubbles in the rectangle
     :param ax: The axis to draw the rectangle on
     :param config: Configuration dictionary
-    :param rect_x: The x-coordinate of the rectangle top left corner
-    :param rect_y: The y-coordinate of the rectangle top left corner
-    :param rect_type: Type of the rectangle (Student ID or Answers)
-    :param last_rect_q: Number of questions in the last rectangle
+    :param box: Layout of the rectangle (see BoxLayout)
     :param student_id: Student ID
     """
     # Configuration
@@ -109,45 +133,28 @@ def draw_bubbles(ax, config, rect_x, rect_y, rect_type, last_rect_q, student_id)
 
     rect_width = config["rect_settings"]["rect_line_width"]
 
-    width = config[rect_type]["width"]
-    height = config[rect_type]["height"]
-
-    cols = config[rect_type]["grid"]["cols"]
-    rows = config[rect_type]["grid"]["rows"]
-
-    # Width and Height of grid cell
-    grid_width = width / cols
-    grid_height = height / rows
-
-    for i in range(cols):
-        for j in range(rows):
-            # Skip the bubbles if this is the last rectangle and the question number is less than the last_rect_q
-            if last_rect_q is not None and j >= last_rect_q:
-                continue
-
-            # Calculate the position of the bubble
-            x = rect_x + grid_width * i
-            y = rect_y + height - (grid_height * (j + 1))
-
+    for i in range(box.cols):
+        # Only the used rows (the last rectangle can have fewer questions)
+        for j in range(box.num_rows):
             # If this is the student ID rectangle, fill the bubbles according to the student ID
             face_color = "none"
-            if rect_type == "student_id_rect":
-                y = rect_y + height - (grid_height * (j + 1))
+            if box.rect_type == "student_id_rect":
                 if student_id != "empty" and student_id[i] == str(j):
                     face_color = rect_color
 
             # Draw the bubble
-            circle = patches.Circle((x + grid_width / 2, y + grid_height / 2), grid_width / 3,
+            circle = patches.Circle(box.bubble_centers[j, i], box.bubble_radius,
                                     edgecolor=rect_color, facecolor=face_color, linewidth=rect_width)
             ax.add_patch(circle)
 
 
-def setup_labels(config, rect_type, last_rect_q=None):
+def setup_labels(config, rect_type, last_rect_q=None, first_question=1):
     """
     Set up the question label and answer label correctly
     :param config: Configuration dictionary
     :param rect_type: Type of the rectangle (Student ID or Answers)
     :param last_rect_q: Number of questions in the last rectangle
+    :param first_question: Number of the first question in the rectangle
     :return: Question label and Answer label
     """
     # Configuration
@@ -159,16 +166,12 @@ def setup_labels(config, rect_type, last_rect_q=None):
 
     # Set up the question label and answer label correctly
     if rect_type == "answer_rect":
-        global question_number  # Global question number counter
-
         # If this is the last rectangle, that could have less questions
         if last_rect_q is not None:
-            q_label = [str(i + question_number) for i in range(last_rect_q)]
-            question_number += last_rect_q
+            q_label = [str(i + first_question) for i in range(last_rect_q)]
         # Else normal rectangle
         else:
-            q_label = [str(i + question_number) for i in range(rows)]
-            question_number += rows
+            q_label = [str(i + first_question) for i in range(rows)]
 
         # If the answer labels are alphabetic use ABCD... else if numeric use 1234...
         if a_label == "alphabetic":
@@ -183,27 +186,19 @@ def setup_labels(config, rect_type, last_rect_q=None):
     return q_label, a_label
 
 
-def draw_labels(ax, config, rect_x, rect_y, rect_type, last_rect_q=None):
+def draw_labels(ax, config, box):
     """
     Draw the labels of questions and answers
     :param ax: The axis to draw the rectangle on
     :param config: Configuration dictionary
-    :param rect_x: The x-coordinate of the rectangle top left corner
-    :param rect_y: The y-coordinate of the rectangle top left corner
-    :param rect_type: Type of the rectangle (Student ID or Answers)
-    :param last_rect_q: Number of questions in the last rectangle
+    :param box: Layout of the rectangle (see BoxLayout)
     """
     # Configuration
     text_color = config["colors"]["text_color"]
 
-    width = config[rect_type]["width"]
-    height = config[rect_type]["height"]
-
+    rect_type = box.rect_type
     label = config[rect_type]["label"]["main"]
 
-    cols = config[rect_type]["grid"]["cols"]
-    rows = config[rect_type]["grid"]["rows"]
-
     label_offset = config[rect_type]["label_offset"]["main"]
     q_offset = config[rect_type]["label_offset"]["rows"]
     a_offset = config[rect_type]["label_offset"]["cols"]
@@ -212,38 +207,27 @@ def draw_labels(ax, config, rect_x, rect_y, rect_type, last_rect_q=None):
     q_label_fontsize = config[rect_type]["label_font_size"]["rows"]
     a_label_fontsize = config[rect_type]["label_font_size"]["cols"]
 
-    # Set up the question label and answer label correctly (or student ID label)
-    q_label, a_label = setup_labels(config, rect_type, last_rect_q=last_rect_q)
-
-    # Width and Height of grid cell
-    grid_width = width / cols
-    grid_height = height / rows
-
     if label != "":
-        ax.text(rect_x + width / 2, rect_y + height + label_offset, label,
+        ax.text(box.x + box.width / 2, box.y + box.height + label_offset, label,
                 ha='center', va='center', fontsize=label_font_size)
 
     # Draw the labels of answers (columns)
-    for i, label in enumerate(a_label):
-        ax.text(rect_x + grid_width * i + grid_width / 2, rect_y + height + a_offset, label,
+    for i, label in enumerate(box.a_labels):
+        ax.text(box.x + box.grid_width * i + box.grid_width / 2, box.y + box.height + a_offset, label,
                 ha='center', va='center', fontsize=a_label_fontsize, color=text_color)
 
     # Draw the labels of questions (rows)
-    for i, label in enumerate(q_label):
-        ax.text(rect_x - q_offset, rect_y + height - (grid_height * i + grid_height / 2), label,
+    for i, label in enumerate(box.q_labels):
+        ax.text(box.x - q_offset, box.y + box.height - (box.grid_height * i + box.grid_height / 2), label,
                 ha='center', va='center', fontsize=q_label_fontsize, color=text_color)
 
 
-def draw_rect(ax, config, rect_x, rect_y, rect_type="answer_rect", gray_columns=False, last_rect_q=None, student_id=0):
+def draw_rect(ax, config, box, student_id=0):
     """
     Draws a rectangle including circles to be filled in the final bubble sheet
     :param ax: The axis to draw the rectangle on
     :param config: Configuration dictionary
-    :param rect_x: The x-coordinate of the rectangle top left corner
-    :param rect_y: The y-coordinate of the rectangle top left corner
-    :param rect_type: Type of the rectangle (Student ID or Answers)
-    :param gray_columns: If true every other column will be grayed out, otherwise every other row
-    :param last_rect_q: Number of questions in the last rectangle
+    :param box: Layout of the rectangle (see BoxLayout)
     :param student_id: Student ID
     """
     # Configuration
@@ -251,48 +235,33 @@ def draw_rect(ax, config, rect_x, rect_y, rect_type="answer_rect", gray_columns=
 
     rect_width = config["rect_settings"]["rect_line_width"]
 
-    width = config[rect_type]["width"]
-    height = config[rect_type]["height"]
-
     # Rounded corners rectangle
-    round_rect = patches.FancyBboxPatch((rect_x, rect_y), width, height, edgecolor=rect_color, facecolor="none",
-                                        linewidth=rect_width, boxstyle="round,pad=0.01")
+    round_rect = patches.FancyBboxPatch((box.x, box.y), box.width, box.height, edgecolor=rect_color, facecolor="none",
+                                        linewidth=rect_width, boxstyle=f"round,pad={RECT_PAD}")
     ax.add_patch(round_rect)
 
     # Gray out every other column or row
-    gray_out(ax, config, rect_x, rect_y, rect_type=rect_type, gray_columns=gray_columns)
+    gray_out(ax, config, box.x, box.y, rect_type=box.rect_type, gray_columns=box.gray_columns)
 
     # Draw the bubbles
     if student_id == "empty":
-        draw_bubbles(ax, config, rect_x, rect_y, rect_type, last_rect_q, student_id)
+        draw_bubbles(ax, config, box, student_id)
     else:
-        draw_bubbles(ax, config, rect_x, rect_y, rect_type, last_rect_q, str(student_id).zfill(4))
+        draw_bubbles(ax, config, box, str(student_id).zfill(4))
 
     # Draw labels
-    draw_labels(ax, config, rect_x, rect_y, rect_type, last_rect_q=last_rect_q)
+    draw_labels(ax, config, box)
 
 
-def draw_page(ax, config, test_id, student_id, page, num_of_pages, num_of_rects_in_page, offset_between_rect, last_rect_q, date, student_name):
+@functools.lru_cache(maxsize=QR_CACHE_SIZE)
+def get_qr_image(test_id, page):
     """
-    Draw a page of the bubble sheet
-    :param ax: Axis to draw the page on
-    :param config: Configuration dictionary
+    Get the QR code image of a page (serves as test identification and rotation indicator)
+    The code depends only on the test and the page, so it is encoded only once and shared by all the students
     :param test_id: Test ID
-    :param student_id: Student ID
-    :param page: Current page number
-    :param num_of_pages: Number of pages
-    :param num_of_rects_in_page: Number of rectangles in each page
-    :param offset_between_rect: Offset between rectangles
-    :param last_rect_q: Number of questions in the last rectangle
-    :param date: Date of the test
-    :param student_name: Student name
+    :param page: Page number
+    :return: QR code (PNG bytes, one pixel block per module, no resampling)
     """
-    # Define the Student ID field
-    x = config["student_id_rect"]["x"]
-    y = config["student_id_rect"]["y"]
-    draw_rect(ax, config, x, y, rect_type="student_id_rect", gray_columns=True, student_id=student_id)
-
-    # Draw QR code to the top right corner serving as pdf rotation indicator also
     qr_data = {"test_id": test_id, "page": page}
     qr = qrcode.QRCode(
         version=1,
@@ -303,28 +272,188 @@ def draw_page(ax, config, test_id, student_id, page, num_of_pages, num_of_rects_
     qr.add_data(json.dumps(qr_data))
     qr.make(fit=True)
     qr = qr.make_image(fill_color="black", back_color="white")
-    qr = qr.resize((100, 100))
-    ax_in_ax = ax.inset_axes([0.87, 0.85, 0.2, 0.2], transform=ax.transAxes)
-    ax_in_ax.imshow(qr)
-    ax_in_ax.axis('off')
+
+    buffer = io.BytesIO()
+    qr.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class BoxLayout:
+    """
+    Layout of one box (rectangle with the bubbles) of the bubble sheet in data coordinates
+    """
+    def __init__(self, config, rect_type, x, y, gray_columns=False, last_rect_q=None, first_question=1):
+        """
+        Initialize the box layout (positions of the bubbles and the labels)
+        :param config: Configuration dictionary
+        :param rect_type: Type of the rectangle (Student ID or Answers)
+        :param x: The x-coordinate of the rectangle top left corner
+        :param y: The y-coordinate of the rectangle top left corner
+        :param gray_columns: If true every other column is grayed out, otherwise every other row
+        :param last_rect_q: Number of questions in the last rectangle (None if the rectangle is full)
+        :param first_question: Number of the first question in the rectangle (answer rectangles only)
+        """
+        self.rect_type = rect_type
+        self.x = x
+        self.y = y
+        self.gray_columns = gray_columns
+        self.last_rect_q = last_rect_q
+        self.first_question = first_question
+
+        self.width = config[rect_type]["width"]
+        self.height = config[rect_type]["height"]
+        self.cols = config[rect_type]["grid"]["cols"]
+        self.rows = config[rect_type]["grid"]["rows"]
+        # Last rectangle can have fewer questions (the first rows are used)
+        self.num_rows = last_rect_q if last_rect_q is not None else self.rows
+
+        # Width and Height of grid cell
+        self.grid_width = self.width / self.cols
+        self.grid_height = self.height / self.rows
+
+        # Question label and answer label (or student ID label)
+        self.q_labels, self.a_labels = setup_labels(config, rect_type, last_rect_q=last_rect_q,
+                                                    first_question=first_question)
+
+        # Centers of the bubbles (rows x cols x (x, y)), the first row is at the top
+        cols, rows = np.meshgrid(np.arange(self.cols), np.arange(self.rows))
+        self.bubble_centers = np.stack([x + self.grid_width * (cols + 0.5),
+                                        y + self.height - self.grid_height * (rows + 0.5)], axis=-1)
+        self.bubble_radius = self.grid_width / 3
+
+
+class SheetLayout:
+    """
+    Layout of the bubble sheet pages for the given number of questions (the same for every student of the test)
+    Used by both the generator and the evaluator, see get_sheet_layout
+    """
+    def __init__(self, config, num_of_q):
+        """
+        Calculate the layout of the pages
+        :param config: Configuration dictionary
+        :param num_of_q: Number of questions
+        """
+        # A4 paper size in inches
+        self.A4 = get_A4_size()
+        self.num_of_q = num_of_q
+
+        # Offset between rectangles
+        self.offset_between_rect = config["rect_settings"]["rect_space_between"]
+
+        # Number of questions
+        self.num_of_q_per_rect = config["answer_rect"]["grid"]["rows"]
+        self.num_of_rect = int(np.ceil(num_of_q / self.num_of_q_per_rect))
+        self.last_rect_q = num_of_q % self.num_of_q_per_rect
+
+        # Calculate the number of rectangles that can fit in the figure
+        self.num_of_rects_per_page = get_max_num_of_rects_in_page(config, self.A4)
+
+        # Calculate the number of pages needed
+        self.num_of_pages = int(np.ceil(self.num_of_rect / self.num_of_rects_per_page))
+
+        # Calculate the number of rectangles in each page
+        self.num_of_rects_in_page = get_num_of_rects_per_page(self.num_of_rect, self.num_of_pages,
+                                                              self.num_of_rects_per_page)
+
+        # Boxes of every page from left to right (student ID box first)
+        self.boxes = []
+        first_question = 1
+        for page in range(self.num_of_pages):
+            # Define the Student ID field
+            x = config["student_id_rect"]["x"]
+            y = config["student_id_rect"]["y"]
+            page_boxes = [BoxLayout(config, "student_id_rect", x, y, gray_columns=True)]
+
+            # Define answers fields
+            x += config["student_id_rect"]["width"] + 2 * self.offset_between_rect
+
+            num_of_rects_this_page = self.num_of_rects_in_page[page]
+            for i in range(num_of_rects_this_page):
+                # Last rectangle has less questions (maybe)
+                last_rect_q = None
+                if i == num_of_rects_this_page - 1 and self.last_rect_q != 0 and page == self.num_of_pages - 1:
+                    last_rect_q = self.last_rect_q
+                page_boxes.append(BoxLayout(config, "answer_rect", x, y, last_rect_q=last_rect_q,
+                                            first_question=first_question))
+
+                # Question numbers continue across all rectangles and pages
+                first_question += self.num_of_q_per_rect
+
+                # Move to the next rectangle
+                x += config["answer_rect"]["width"] + 1.5 * self.offset_between_rect
+
+            self.boxes.append(page_boxes)
+
+
+def get_sheet_layout(config, num_of_q):
+    """
+    Get the layout of the bubble sheet (calculated only once for every configuration and number of questions)
+    :param config: Configuration dictionary
+    :param num_of_q: Number of questions
+    :return: Sheet layout (shared, must not be modified)
+    """
+    key = (hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest(), num_of_q)
+    with sheet_layouts_lock:
+        layout = sheet_layouts.get(key)
+        if layout is None:
+            layout = SheetLayout(config, num_of_q)
+            sheet_layouts[key] = layout
+    return layout
+
+
+def draw_page(ax, config, layout, student_id, page, date, student_name):
+    """
+    Draw a page of the bubble sheet (without the QR code, it is inserted into the PDF page, see save_page)
+    :param ax: Axis to draw the page on
+    :param config: Configuration dictionary
+    :param layout: Layout of the bubble sheet (see SheetLayout)
+    :param student_id: Student ID
+    :param page: Current page number
+    :param date: Date of the test
+    :param student_name: Student name
+    """
+    # Student ID field and the answers fields
+    student_id_box, *answer_boxes = layout.boxes[page]
+    draw_rect(ax, config, student_id_box, student_id=student_id)
 
     # Draw the header
-    draw_header(ax, config, x, 1 - y, date, student_name)
+    draw_header(ax, config, student_id_box.x, 1 - student_id_box.y, date, student_name)
 
-    # Define answers fields
-    x += config["student_id_rect"]["width"] + 2 * offset_between_rect
+    for box in answer_boxes:
+        draw_rect(ax, config, box)
 
-    num_of_rects_this_page = num_of_rects_in_page[page]
-    for i in range(num_of_rects_this_page):
-        # Last rectangle has less questions (maybe)
-        if i == num_of_rects_this_page - 1 and last_rect_q != 0 and page == num_of_pages - 1:
-            draw_rect(ax, config, x, y, last_rect_q=last_rect_q)
-        # Normal rectangle
-        else:
-            draw_rect(ax, config, x, y)
 
-        # Move to the next rectangle
-        x += config["answer_rect"]["width"] + 1.5 * offset_between_rect
+def save_page(fig, ax):
+    """
+    Save the figure of the page as a PDF page, the place of the QR code is kept free (see QR_INSET)
+    :param fig: Figure of the page
+    :param ax: Axis the page is drawn on (see draw_page)
+    :return: PDF page (bytes), data coordinates -> PDF coordinates transform (scale_x, scale_y, offset_x, offset_y)
+             and the position of the QR code (PDF coordinates)
+    """
+    # Draw once, so the final limits (aspect ratio) are known
+    fig.canvas.draw()
+
+    # The QR code is inserted later, but it still has to be a part of the page (the same way imshow would place it)
+    (x0, y0), (x1, y1) = ax.transAxes.transform([QR_INSET[:2], [QR_INSET[0] + QR_INSET[2], QR_INSET[1] + QR_INSET[3]]]) / fig.dpi
+    side = min(x1 - x0, y1 - y0)
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    qr_bbox = Bbox.from_extents(cx - side / 2, cy - side / 2, cx + side / 2, cy + side / 2)
+
+    # Page bounding box (in inches) -- the same one bbox_inches="tight" would produce
+    bbox = Bbox.union([fig.get_tightbbox(fig.canvas.get_renderer()), qr_bbox])
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='pdf', bbox_inches=bbox, pad_inches=0)
+
+    # Data coordinates -> inches -> PDF points (PDF origin is the top left corner)
+    (ox, oy), (ux, uy) = ax.transData.transform([(0, 0), (1, 1)]) / fig.dpi
+    transform = ((ux - ox) * POINTS_PER_INCH, (oy - uy) * POINTS_PER_INCH,
+                 (ox - bbox.x0) * POINTS_PER_INCH, (bbox.y1 - oy) * POINTS_PER_INCH)
+    qr_rect = fitz.Rect((qr_bbox.x0 - bbox.x0) * POINTS_PER_INCH, (bbox.y1 - qr_bbox.y1) * POINTS_PER_INCH,
+                        (qr_bbox.x1 - bbox.x0) * POINTS_PER_INCH, (bbox.y1 - qr_bbox.y0) * POINTS_PER_INCH)
+
+    return buffer.getvalue(), transform, qr_rect
 
 
 def generate_bubble_sheet(test_id, student_id, num_of_q, date, student_name):
@@ -335,66 +464,185 @@ def generate_bubble_sheet(test_id, student_id, num_of_q, date, student_name):
     :param num_of_q: Number of questions
     :param date: Date of the test
     :param student_name: Student name
+    :return: Bubble sheet (fitz Document)
     """
-    global question_number
-    question_number = 1
-
     # Load the configuration file
     config = load_config()
 
-    # A4 paper size in inches
-    A4 = get_A4_size()
-
-    # Offset between rectangles
-    offset_between_rect = config["rect_settings"]["rect_space_between"]
-
-    # Number of questions
-    num_of_q_per_rect = config["answer_rect"]["grid"]["rows"]
-    num_of_rect = int(np.ceil(num_of_q / num_of_q_per_rect))
-    last_rect_q = num_of_q % num_of_q_per_rect
-
-    # Calculate the number of rectangles that can fit in the figure
-    num_of_rects_per_page = get_max_num_of_rects_in_page(config, A4)
-
-    # Calculate the number of pages needed
-    num_of_pages = int(np.ceil(num_of_rect / num_of_rects_per_page))
-
-    # Calculate the number of rectangles in each page
-    num_of_rects_in_page = get_num_of_rects_per_page(num_of_rect, num_of_pages, num_of_rects_per_page)
+    # Layout of the pages (shared by all the students of the test)
+    layout = get_sheet_layout(config, num_of_q)
 
     # Generate the bubble sheet for each page
-    sub_pdfs = []
-    for page in range(num_of_pages):
+    merged_pdf = fitz.open()
+    for page in range(layout.num_of_pages):
         # Create a figure
-        fig, ax = plt.subplots(figsize=A4, dpi=300)
+        fig, ax = plt.subplots(figsize=layout.A4, dpi=300)
 
         # Set the aspect of the plot to be equal
         ax.set_aspect('equal', adjustable='datalim')
 
-        draw_page(ax, config, test_id, student_id, page, num_of_pages, num_of_rects_in_page, offset_between_rect, last_rect_q, date, student_name)
+        draw_page(ax, config, layout, student_id, page, date, student_name)
 
         # Turn off the axis but keep the frame
         ax.axis("off")
-        # Save the figure as a PDF file
-        file_name = f"generated_pdfs/{student_id}_bubble_sheet_page_{page + 1}.pdf"
-        sub_pdfs.append(file_name)
-        plt.savefig(file_name, format='pdf', bbox_inches='tight', pad_inches=0)
+        # Save the figure as a PDF page (in memory) and merge it
+        page_data, _, qr_rect = save_page(fig, ax)
+        with fitz.open("pdf", page_data) as page_pdf:
+            merged_pdf.insert_pdf(page_pdf)
+
+        # Draw QR code to the top right corner serving as pdf rotation indicator also
+        merged_pdf[-1].insert_image(qr_rect, stream=get_qr_image(test_id, page))
 
         # Cleanup
         plt.close()
         fig.clf()
 
-    # Merge the PDFs now
-    merged_pdf = fitz.open()
-    for pdf in sub_pdfs:
-        with fitz.open(pdf) as pdf_file:
-            merged_pdf.insert_pdf(pdf_file)
-
-    # Save the final PDF
-    final_pdf = f"generated_pdfs/{student_id}_bubble_sheet.pdf"
-    merged_pdf.save(final_pdf)
-    merged_pdf.close()
-
-    # Remove the sub PDFs
-    for pdf in sub_pdfs:
-        os.remove(pdf)
+    return merged_pdf
+
+
+class BubbleSheetTemplate:
+    """
+    Bubble sheet template of one test
+    The static layout (boxes, gray stripes, empty bubbles, labels, title and date) is drawn with matplotlib only once
+    per test, the parts that change per student (filled student ID bubbles, name and QR code) are then stamped
+    on top of it with PyMuPDF drawing calls
+    """
+    def __init__(self, test_id, num_of_q, date):
+        """
+        Initialize the template (draw the static layout of every page)
+        :param test_id: Test ID
+        :param num_of_q: Number of questions
+        :param date: Date of the test
+        """
+        # Load the configuration file
+        self.config = load_config()
+
+        # Layout of the pages (shared with the evaluator)
+        self.layout = get_sheet_layout(self.config, num_of_q)
+
+        # A4 paper size in inches
+        self.A4 = self.layout.A4
+
+        # Font of the header (stamped name)
+        font = self.config["header"]["font"]
+        font_file = f"res/fonts/{font.lower()}/{font}.ttf"
+        self.font_file = font_file if os.path.exists(font_file) else None
+        self.font = fitz.Font(fontfile=self.font_file) if self.font_file else fitz.Font("helv")
+
+        self.document = fitz.open()  # Static layout, one page per bubble sheet page
+        self.transforms = []  # Data coordinates -> PDF coordinates (scale_x, scale_y, offset_x, offset_y) per page
+        self.qr_rects = []  # QR code position per page
+        self.qr_images = []  # QR code (PNG) per page
+        # QR code image objects of the document the sheets are rendered to (one per page, shared by all the students)
+        self.qr_document = None
+        self.qr_xrefs = {}
+
+        for page in range(self.layout.num_of_pages):
+            # Create a figure
+            fig, ax = plt.subplots(figsize=self.A4, dpi=300)
+
+            # Set the aspect of the plot to be equal
+            ax.set_aspect('equal', adjustable='datalim')
+
+            draw_page(ax, self.config, self.layout, "empty", page, date, None)
+
+            # Turn off the axis but keep the frame
+            ax.axis("off")
+
+            # Save the figure as a PDF page of the template
+            page_data, transform, qr_rect = save_page(fig, ax)
+            with fitz.open("pdf", page_data) as page_pdf:
+                self.document.insert_pdf(page_pdf)
+            self.transforms.append(transform)
+            self.qr_rects.append(qr_rect)
+            self.qr_images.append(get_qr_image(test_id, page))
+
+            # Cleanup
+            plt.close(fig)
+
+    def to_pdf(self, page, x, y):
+        """
+        Convert data coordinates (matplotlib) to PDF coordinates
+        :param page: Page number
+        :param x: The x-coordinate (data)
+        :param y: The y-coordinate (data)
+        :return: Point in PDF coordinates
+        """
+        scale_x, scale_y, offset_x, offset_y = self.transforms[page]
+        return fitz.Point(offset_x + x * scale_x, offset_y + y * scale_y)
+
+    def stamp_header(self, pdf_page, page, student_name):
+        """
+        Stamp the student name into the header (see draw_header)
+        :param pdf_page: PDF page to stamp on
+        :param page: Page number
+        :param student_name: Student name
+        """
+        # Configuration
+        header_name = self.config["header"]["name"] + student_name
+        font_size = self.config["header"]["font_size"]
+        font_size_relative = get_header_font_size_relative(self.config, self.A4[1])
+        text_color = to_rgb(self.config["colors"]["main_color"])
+
+        x = self.config["student_id_rect"]["x"] - font_size_relative
+        y = 1 - self.config["student_id_rect"]["y"] - font_size_relative - font_size_relative * 2
+
+        # The text is aligned to the bottom, PDF needs the baseline
+        point = self.to_pdf(page, x, y)
+        point.y += self.font.descender * font_size
+        pdf_page.insert_text(point, header_name, fontsize=font_size, fontname="header", fontfile=self.font_file,
+                             color=text_color)
+
+    def stamp_student_id(self, pdf_page, page, student_id):
+        """
+        Fill the student ID bubbles (see draw_bubbles)
+        :param pdf_page: PDF page to stamp on
+        :param page: Page number
+        :param student_id: Student ID (zero padded string)
+        """
+        # Configuration
+        rect_color = to_rgb(self.config["colors"]["main_color"])
+        rect_width = self.config["rect_settings"]["rect_line_width"]
+
+        box = self.layout.boxes[page][0]
+        scale_x, _, _, _ = self.transforms[page]
+
+        shape = pdf_page.new_shape()
+        for i, digit in enumerate(student_id[:box.cols]):
+            x, y = box.bubble_centers[int(digit), i]
+            shape.draw_circle(self.to_pdf(page, x, y), box.bubble_radius * scale_x)
+        shape.finish(color=rect_color, fill=rect_color, width=rect_width)
+        shape.commit()
+
+    def render(self, doc, student_id, student_name):
+        """
+        Append the bubble sheet of one student to the document
+        :param doc: Document (fitz) the pages are appended to
+        :param student_id: Student ID (number from 0 to 9999 or "empty")
+        :param student_name: Student name
+        """
+        for page in range(len(self.document)):
+            template_page = self.document[page]
+            pdf_page = doc.new_page(width=template_page.rect.width, height=template_page.rect.height)
+
+            # Static layout (shared by all the pages of the document)
+            pdf_page.show_pdf_page(pdf_page.rect, self.document, page)
+
+            # Student specific parts
+            self.stamp_header(pdf_page, page, student_name)
+            if student_id != "empty":
+                self.stamp_student_id(pdf_page, page, str(student_id).zfill(4))
+            self.stamp_qr(doc, pdf_page, page)
+
+    def stamp_qr(self, doc, pdf_page, page):
+        """
+        Insert the QR code of the page (the image is stored only once in the document and reused by every student)
+        :param doc: Document (fitz) the page belongs to
+        :param pdf_page: PDF page to stamp on
+        :param page: Page number
+        """
+        if doc is not self.qr_document:
+            self.qr_document = doc
+            self.qr_xrefs = {}
+        self.qr_xrefs[page] = pdf_page.insert_image(self.qr_rects[page], stream=self.qr_images[page],
+                                                    xref=self.qr_xrefs.get(page, 0))
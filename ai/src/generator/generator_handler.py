@@ -1,11 +1,14 @@
-import os
 import fitz
 import uuid
 import numpy as np
 import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-from ai.src.generator.bubble_sheet_generator import generate_bubble_sheet
-from ai.src.generator.question_paper_generator import generate_question_paper
+from ai.src.utils import load_config
+from ai.src.db.quiz_store import save_test, find_test, find_students, save_students
+from ai.src.generator.bubble_sheet_generator import BubbleSheetTemplate
+from ai.src.generator.question_paper_generator import generate_question_paper, render_question_papers, QuestionPaperRenderer
 
 
 class Student:
@@ -128,6 +131,78 @@ def shuffled_questions(questions_list):
     return shuffle, shuffled_list
 
 
+def apply_shuffle(questions_list, shuffle):
+    """
+    Order the questions and their answers by the saved shuffle (see shuffled_questions)
+    :param questions_list: List of questions (in the original order)
+    :param shuffle: Shuffle of the student
+    :return: Shuffled list
+    """
+    shuffled_list = []
+    for obj in shuffle:
+        question = copy.deepcopy(questions_list[obj["question"]])
+        question.answers = [question.answers[i] for i in obj["answers"]]
+        shuffled_list.append(question)
+
+    return shuffled_list
+
+
+def question_paper_args(student, student_questions, date):
+    """
+    Arguments of the question paper of the student
+    :param student: Student
+    :param student_questions: Questions of the student (shuffled)
+    :param date: Date of the test
+    :return: Arguments (see QuestionPaperRenderer.render)
+    """
+    student_name = student.name + " " + student.surname
+    questions_text = [f"({int(float(question.default_grade))}b) {question.name}\n{question.text}" for question in student_questions]
+    answers_text = []
+    for question in student_questions:
+        answers_text.append([answer["text"] for answer in question.answers])
+
+    return student.id, questions_text, answers_text, date, student_name
+
+
+def generate_question_papers(config, papers):
+    """
+    Generate the question papers (merged in the student order, no matter the order of completion)
+    :param config: Configuration dictionary
+    :param papers: Arguments of the question paper of every student (see question_paper_args)
+    :return: Merged question papers (fitz Document)
+    """
+    # Number of processes generating the question papers (1 means no parallelism)
+    workers = config["workers"]["generator"]
+
+    if config["question_papers"]["engine"] == "native" and (workers <= 1 or len(papers) <= 1):
+        # All the papers are laid out in this process straight into the merged document
+        return QuestionPaperRenderer().render(papers)
+
+    merged_pdf_q = fitz.open()
+    # Spawned, not forked - the server runs threads (QR code warmup, other requests), a forked worker could
+    # inherit their locks held and wait for them forever
+    mp_context = multiprocessing.get_context("spawn")
+    if config["question_papers"]["engine"] == "native":
+        # One contiguous chunk of students per process (the fonts are embedded once per chunk)
+        chunk_size = int(np.ceil(len(papers) / workers))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            futures = [executor.submit(render_question_papers, papers[i:i + chunk_size])
+                       for i in range(0, len(papers), chunk_size)]
+            question_papers = [future.result() for future in futures]
+    elif workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            futures = [executor.submit(generate_question_paper, *paper) for paper in papers]
+            question_papers = [future.result() for future in futures]
+    else:
+        question_papers = [generate_question_paper(*paper) for paper in papers]
+
+    for question_paper in question_papers:
+        with fitz.open(stream=question_paper, filetype="pdf") as pdf_q:
+            merged_pdf_q.insert_pdf(pdf_q)
+
+    return merged_pdf_q
+
+
 def generate_sheets(collection, questions_json, students_json, date, gc=False):
     """
     Generate bubble sheets and question papers for the students
@@ -135,63 +210,113 @@ def generate_sheets(collection, questions_json, students_json, date, gc=False):
     :param questions_json: Questions JSON (from the request)
     :param students_json: Students JSON (from the request)
     :param date: Date of the test
+    :param gc: True if the data come from Google Classroom (not Moodle)
+    :return: Merged bubble sheets and merged question papers (PDF bytes)
     """
+    # Load the configuration file
+    config = load_config()
+
     students, questions = preprocess_data(students_json, questions_json)
     test_id = uuid.uuid4().hex
     test_length = len(questions)
 
-    for student in students:
-        student_name = student.name + " " + student.surname
+    # Static layout of the bubble sheets is drawn only once for the whole test
+    template = BubbleSheetTemplate(test_id, test_length, date)
+    merged_pdf_a = fitz.open()
+
+    # Generate one student-less bubble sheet
+    template.render(merged_pdf_a, "empty", "")
+
+    # Arguments of the question paper of every student
+    papers = []
 
+    for student in students:
         # generate bubble sheet with unique id for every student
-        generate_bubble_sheet(test_id, student.id, test_length, date, student_name)
+        template.render(merged_pdf_a, student.id, student.name + " " + student.surname)
 
-        # generate question paper with unique set of questions
+        # unique set of questions (shuffled here, so the saved shuffles always match the printed papers)
         shuffle, student_questions = shuffled_questions(questions)
         student.shuffle = shuffle
 
-        questions_text = [f"({int(float(question.default_grade))}b) {question.name}\n{question.text}" for question in student_questions]
-        answers_text = []
-        for question in student_questions:
-            answers_text.append([answer["text"] for answer in question.answers])
+        papers.append(question_paper_args(student, student_questions, date))
 
-        generate_question_paper(student.id, questions_text, answers_text, date, student_name)
+    # generate question papers
+    merged_pdf_q = generate_question_papers(config, papers)
 
     # Save the data to the database
-    collection.insert_one(
-        {
-            "test_id": test_id,
-            "gc": gc,
-            "num_of_questions": test_length,
-            "students": [student.to_dict() for student in students],
-            "questions": [question.to_dict() for question in questions]
-        }
-    )
+    save_test(collection, test_id, gc, test_length,
+              [student.to_dict() for student in students],
+              [question.to_dict() for question in questions],
+              split_layout=config["database"]["split_layout"], date=date)
 
-    # Generate one student-less bubble sheet
-    generate_bubble_sheet(test_id, "empty", test_length, date, "")
+    # Keep only the used glyphs of the stamped font
+    merged_pdf_a.subset_fonts()
 
-    # Mkdir if not exists
-    if not os.path.exists("generated_pdfs"):
-        os.makedirs("generated_pdfs")
+    return merged_pdf_a.tobytes(garbage=3, deflate=True), merged_pdf_q.tobytes(garbage=1, deflate=True)
 
-    # PDFs to be merged
-    pdfs_q = [f"generated_pdfs/{student.id}_question_paper.pdf" for student in students]
-    pdfs_a = ["generated_pdfs/empty_bubble_sheet.pdf"] + [f"generated_pdfs/{student.id}_bubble_sheet.pdf" for student in students]
 
-    # Merge the PDFs
-    merged_pdf_q = fitz.open()
+def regenerate_sheets(collection, test_id, students_json, date=None):
+    """
+    Add new students to an existing test or generate the printouts of some of its students again (e.g. after the name
+    was corrected) - only the given students are rendered, the saved questions and shuffles are reused
+    :param collection: DB collection
+    :param test_id: Test ID
+    :param students_json: Students JSON (the same format as for generate_sheets), the saved students are given
+                          by the key "id", the students without it are added as new ones
+    :param date: Date of the test, if None, the saved one is used
+    :return: Merged bubble sheets and merged question papers of the given students (PDF bytes) and the students
+             (ID and name, in the given order)
+    """
+    # Load the configuration file
+    config = load_config()
+
+    test = find_test(collection, test_id, {"_id": 0, "num_of_questions": 1, "questions": 1, "date": 1})
+    if test is None:
+        raise ValueError(f"Test {test_id} not found in the database")
+    if date is None:
+        date = test.get("date")
+    if date is None:
+        raise ValueError(f"Date of test {test_id} is not saved, it has to be given")
+
+    questions = [Question(**question) for question in test["questions"]]
+    saved_students, next_id = find_students(collection, test_id, [student["id"] for student in students_json
+                                                                  if "id" in student])
+
+    students, _ = preprocess_data(students_json, [])
+    new_ids = set()
+    for student, student_json in zip(students, students_json):
+        if "id" in student_json:
+            if student_json["id"] not in saved_students:
+                raise ValueError(f"Student {student_json['id']} not found in test {test_id}")
+            # The same ID and the same questions as on the original printouts
+            student.id = student_json["id"]
+            student.shuffle = saved_students[student.id]["shuffle"]
+        else:
+            student.id = next_id
+            student.shuffle, _ = shuffled_questions(questions)
+            new_ids.add(next_id)
+            next_id += 1
+
+    # The student ID has to fit into the bubbles of the sheet
+    if next_id > 10 ** config["student_id_rect"]["grid"]["cols"]:
+        raise ValueError(f"There are no free student IDs left in test {test_id}")
+
+    # Static layout of the bubble sheets is drawn only once (only the pages of the given students are rendered)
+    template = BubbleSheetTemplate(test_id, test["num_of_questions"], date)
     merged_pdf_a = fitz.open()
 
-    for pdf_q in pdfs_q:
-        merged_pdf_q.insert_pdf(fitz.open(pdf_q))
-    for pdf_a in pdfs_a:
-        merged_pdf_a.insert_pdf(fitz.open(pdf_a))
+    papers = []
+    for student in students:
+        template.render(merged_pdf_a, student.id, student.name + " " + student.surname)
+        papers.append(question_paper_args(student, apply_shuffle(questions, student.shuffle), date))
+
+    merged_pdf_q = generate_question_papers(config, papers)
+
+    # Save the data to the database (after the rendering, nothing is saved if it fails)
+    save_students(collection, test_id, [student.to_dict() for student in students], new_ids)
 
-    # Save the merged PDFs
-    merged_pdf_q.save("generated_pdfs/question_papers.pdf")
-    merged_pdf_a.save("generated_pdfs/bubble_sheets.pdf")
+    # Keep only the used glyphs of the stamped font
+    merged_pdf_a.subset_fonts()
 
-    # Remove the temporary PDFs
-    for pdf in pdfs_q + pdfs_a:
-        os.remove(pdf)
+    students_info = [{"id": student.id, "name": student.name, "surname": student.surname} for student in students]
+    return merged_pdf_a.tobytes(garbage=3, deflate=True), merged_pdf_q.tobytes(garbage=1, deflate=True), students_info
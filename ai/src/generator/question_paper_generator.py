@@ -1,21 +1,95 @@
+import io
+import re
+import html
 import pdfkit
 import fitz
 import os
 import platform
+import matplotlib
+from matplotlib import mathtext
+from matplotlib.font_manager import FontProperties
 
+# Use Agg backend for matplotlib
+matplotlib.use("Agg")
 
-def generate_question_paper(student_id, student_questions, question_answers, date, student_name):
+# Font size of the question papers (points)
+FONT_SIZE = 14
+# Inline formula (after the $$ -> $ replacement)
+FORMULA_PATTERN = re.compile(r"\$(.+?)\$", re.DOTALL)
+# Native renderer (PyMuPDF Story): page margins (left, top, right, bottom in points) and the page number footer
+PAGE_MARGINS = (36, 36, 36, 54)
+FOOTER_FONT_SIZE = 10
+# Fonts of the native renderer (the same Arial as the bubble sheets, MuPDF built-in fonts are used if it is missing)
+FONT_DIR = "res/fonts/arial"
+FONT_FILES = {
+    ("normal", "normal"): "Arial.ttf",
+    ("bold", "normal"): "Arial_Bold.ttf",
+    ("normal", "italic"): "Arial_Italic.ttf",
+    ("bold", "italic"): "Arial_Bold_Italic.ttf",
+}
+
+
+def question_paper_body(student_id, student_questions, question_answers, date, student_name, fragments=None):
     """
-    Generate a question paper in PDF format
+    Build the body of the question paper (HTML)
     :param student_id: ID of the student
     :param student_questions: Questions of the student
     :param question_answers: Answers to the questions
     :param date: Date of the test
     :param student_name: Name of the student
+    :param fragments: Cache of the texts with the rendered formulas (FragmentCache), if None, the formulas are left
+                      for MathJax
+    :return: HTML of the body
+    """
+    html_string = f"""
+    <div style='word-wrap: break-word;'>
+    <h1><b>Otázky k testu</b></h1>
+    <b>Jméno</b>: {student_name}<br>
+    <b>Datum</b>: {date}<br>
+    <b>ID Studenta</b>: {student_id}<br>
+    </div><hr>
     """
-    # Filename of the generated PDF (output)
-    filename = 'generated_pdfs/' + str(student_id) + '_question_paper.pdf'
 
+    # Add the questions and answers to the HTML string
+    for i in range(len(student_questions)):
+        question = student_questions[i]
+        answers = question_answers[i]
+
+        # Replace the $$ with $ for MathJax
+        question = question.replace("$$", "$")
+        if fragments is not None:
+            question = fragments.get(question)
+
+        html_string += f"""
+        <div style='word-wrap: break-word;'>
+        <b>Otázka {i + 1}</b>: {question}<br>
+        <div style='margin-left: 50px;'>
+        """
+
+        for j, answer in enumerate(answers):
+            # Replace the $$ with $ for MathJax
+            answer = answer.replace("$$", "$").replace("<br>", "")
+            if fragments is not None:
+                answer = fragments.get(answer)
+
+            answer_letter = chr(65 + j) + "."
+            html_string += f"<b>{answer_letter}</b> {answer}<br>"
+
+        html_string += "</div></div><hr>"
+
+    return html_string
+
+
+def generate_question_paper(student_id, student_questions, question_answers, date, student_name):
+    """
+    Generate a question paper in PDF format (wkhtmltopdf, one process per student, formulas typeset by MathJax)
+    :param student_id: ID of the student
+    :param student_questions: Questions of the student
+    :param question_answers: Answers to the questions
+    :param date: Date of the test
+    :param student_name: Name of the student
+    :return: Question paper (PDF bytes)
+    """
     # Initialize the path to wkhtmltopdf
     path_to_wkhtmltopdf = None
 
@@ -47,53 +121,160 @@ def generate_question_paper(student_id, student_questions, question_answers, dat
     </script>
     <body>
     """
-    html_string += f"""
-    <div style='word-wrap: break-word;'>
-    <h1><b>Otázky k testu</b></h1>
-    <b>Jméno</b>: {student_name}<br>
-    <b>Datum</b>: {date}<br>
-    <b>ID Studenta</b>: {student_id}<br>
-    </div><hr>
+    html_string += question_paper_body(student_id, student_questions, question_answers, date, student_name)
+    html_string += "</body></html>"
+
+    config = pdfkit.configuration(wkhtmltopdf=path_to_wkhtmltopdf)
+    options = {
+        "footer-center": "[page] / [topage]",
+        "footer-font-size": 10,
+        "javascript-delay": 1000,  # Wait for MathJax to render
+    }
+
+    # Generate the PDF (False as output path returns the PDF in memory)
+    pdf_data = pdfkit.from_string(html_string, False, configuration=config, options=options)
+
+    # Add a blank page if the number of pages is odd
+    with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+        if doc.page_count % 2 != 0:
+            doc.new_page()
+            pdf_data = doc.tobytes()
+
+    return pdf_data
+
+
+def render_question_papers(papers):
     """
+    Render the question papers natively (function to be used for parallel processing)
+    :param papers: Arguments of every paper (see QuestionPaperRenderer.render)
+    :return: Question papers (PDF bytes)
+    """
+    with QuestionPaperRenderer().render(papers) as doc:
+        return doc.tobytes(garbage=1, deflate=True)
 
-    # Add the questions and answers to the HTML string
-    for i in range(len(student_questions)):
-        question = student_questions[i]
-        answers = question_answers[i]
 
-        # Replace the $$ with $ for MathJax
-        question = question.replace("$$", "$")
+class FragmentCache:
+    """
+    Texts of the questions and answers with the formulas rendered as vector images (SVG)
+    Every student has the same questions (only in a different order), so every text and every formula
+    is rendered only once per test and reused by all the papers
+    """
+    def __init__(self, archive):
+        """
+        Initialize the cache
+        :param archive: Archive (fitz) the rendered formulas are added to (the one used by the Story)
+        """
+        self.archive = archive
+        self.fragments = {}  # Text -> HTML with the images of the formulas
+        self.formulas = {}  # TeX -> name of the image in the archive (None if it could not be rendered)
 
-        html_string += f"""
-        <div style='word-wrap: break-word;'>
-        <b>Otázka {i + 1}</b>: {question}<br>
-        <div style='margin-left: 50px;'>
+    def get(self, text):
         """
+        Get the text with the formulas replaced by their images
+        :param text: Text of the question or answer (HTML with $...$ formulas)
+        :return: HTML fragment
+        """
+        fragment = self.fragments.get(text)
+        if fragment is None:
+            fragment = FORMULA_PATTERN.sub(self.formula_image, text)
+            self.fragments[text] = fragment
+        return fragment
 
-        for j, answer in enumerate(answers):
-            # Replace the $$ with $ for MathJax
-            answer = answer.replace("$$", "$").replace("<br>", "")
+    def formula_image(self, match):
+        """
+        Render the formula (only the first time it is seen)
+        :param match: Match of FORMULA_PATTERN
+        :return: Image tag of the formula, or the original text if the formula could not be rendered
+        """
+        tex = html.unescape(match.group(1))
+        if tex not in self.formulas:
+            buffer = io.BytesIO()
+            try:
+                mathtext.math_to_image(f"${tex}$", buffer, prop=FontProperties(size=FONT_SIZE), format="svg")
+                name = f"formula{len(self.formulas)}.svg"
+                self.archive.add((buffer.getvalue(), name))
+                self.formulas[tex] = name
+            except ValueError:
+                # Not supported by matplotlib mathtext, the TeX source is printed instead
+                self.formulas[tex] = None
 
-            answer_letter = chr(65 + j) + "."
-            html_string += f"<b>{answer_letter}</b> {answer}<br>"
+        name = self.formulas[tex]
+        return f"<img src='{name}'/>" if name is not None else match.group(0)
 
-        html_string += "</div></div><hr>"
 
-    html_string += "</body></html>"
+class QuestionPaperRenderer:
+    """
+    Native question paper renderer (PyMuPDF Story)
+    The papers of all students are laid out in-process into one document (the fonts are embedded only once),
+    no external process is started per student
+    """
+    def __init__(self):
+        """
+        Initialize the renderer (fonts and styles shared by all the papers)
+        """
+        # Fonts and the rendered formulas
+        self.archive = fitz.Archive()
+        self.fragments = FragmentCache(self.archive)
+        font_css = ""
+        font_family = "sans-serif"
+        if all(os.path.exists(os.path.join(FONT_DIR, file)) for file in FONT_FILES.values()):
+            self.archive.add(FONT_DIR)
+            for (weight, style), file in FONT_FILES.items():
+                font_css += (f"@font-face {{font-family: Arial; src: url({file}); "
+                             f"font-weight: {weight}; font-style: {style};}}\n")
+            font_family = "Arial"
+        self.css = font_css + f"* {{ font-size: {FONT_SIZE}pt; font-family: {font_family}; }}"
 
-    config = pdfkit.configuration(wkhtmltopdf=path_to_wkhtmltopdf)
-    options = {
-        "footer-center": "[page] / [topage]",
-        "footer-font-size": 10,
-        "javascript-delay": 1000,  # Wait for MathJax to render
-    }
+        self.page_rect = fitz.paper_rect("a4")
+        left, top, right, bottom = PAGE_MARGINS
+        self.content_rect = self.page_rect + (left, top, -right, -bottom)
+        self.footer_rect = fitz.Rect(left, self.page_rect.height - bottom * 2 / 3, self.page_rect.width - right,
+                                     self.page_rect.height)
 
-    # Generate the PDF
-    pdfkit.from_string(html_string, filename, configuration=config, options=options)
+    def render(self, papers):
+        """
+        Render the question papers
+        :param papers: Arguments of every paper (student_id, student_questions, question_answers, date, student_name)
+        :return: Document (fitz) with all the papers in the given order, every paper has an even number of pages
+        """
+        buffer = io.BytesIO()
+        writer = fitz.DocumentWriter(buffer)
 
-    # Add a blank page if the number of pages is odd
-    doc = fitz.open(filename)
-    if doc.page_count % 2 != 0:
-        doc.new_page()
-        doc.saveIncr()
-    doc.close()
+        for paper in papers:
+            story = fitz.Story(question_paper_body(*paper, fragments=self.fragments), user_css=self.css,
+                               archive=self.archive)
+
+            # Lay out the paper once to count its pages (for the footer), then draw it
+            num_of_pages = 0
+            more = True
+            while more:
+                more, _ = story.place(self.content_rect)
+                story.draw(None)  # Only moves to the next page
+                num_of_pages += 1
+            story.reset()
+
+            for page_num in range(num_of_pages):
+                device = writer.begin_page(self.page_rect)
+                story.place(self.content_rect)
+                story.draw(device)
+                self.draw_footer(device, f"{page_num + 1} / {num_of_pages}")
+                writer.end_page()
+
+            # Add a blank page if the number of pages is odd (every paper starts on a new sheet)
+            if num_of_pages % 2 != 0:
+                writer.begin_page(self.page_rect)
+                writer.end_page()
+
+        writer.close()
+        return fitz.open(stream=buffer.getvalue(), filetype="pdf")
+
+    def draw_footer(self, device, text):
+        """
+        Draw the footer of the page (page number as wkhtmltopdf would write)
+        :param device: Device of the page (DocumentWriter)
+        :param text: Text of the footer
+        """
+        footer = fitz.Story(f"<p style='text-align: center; font-size: {FOOTER_FONT_SIZE}pt;'>{text}</p>",
+                            user_css=self.css, archive=self.archive)
+        footer.place(self.footer_rect)
+        footer.draw(device)